@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Compare two audio files and report how different they are.
+
+Exits with a non-zero status when the files differ by more than the
+tolerance so it can be used to check that a change to a generator didn't
+change its output.
+"""
+
+from potty_oh.common import get_cmd_line_parser
+from potty_oh.common import call_main
+from potty_oh.common import defaults
+from potty_oh.compare import compare
+
+
+def main():
+    parser = get_cmd_line_parser(description=__doc__)
+    parser.add_argument('first', help='The reference audio file.')
+    parser.add_argument('second', help='The audio file to compare.')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.0,
+        help='Largest absolute sample difference considered unchanged.')
+    parser.add_argument(
+        '--block-size', type=int, default=defaults.block_size,
+        help='Number of frames to read from each file at a time.')
+    args = parser.parse_args()
+
+    report = compare(args.first, args.second, args.block_size,
+                     args.tolerance)
+    print(report)
+    return 0 if report.identical else 1
+
+
+if __name__ == "__main__":
+    call_main(main)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Analyze a set of rendered audio files in parallel.
+
+Spectra, spectral peaks and pitch tracks for each file are saved to a store
+directory. Files that haven't changed since the last run are skipped.
+"""
+
+import os
+from glob import glob
+
+from potty_oh.common import get_cmd_line_parser
+from potty_oh.common import call_main
+from potty_oh.batch_analysis import analyze_files
+
+
+def expand_paths(paths):
+    """Replace any directories in paths with the wav files they contain."""
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(glob(os.path.join(path, '*.wav'))):
+                yield filename
+        else:
+            yield path
+
+
+def main():
+    parser = get_cmd_line_parser(description=__doc__)
+    parser.add_argument(
+        'paths', nargs='+',
+        help='Audio files or directories of wav files to analyze.')
+    parser.add_argument(
+        '-o', '--store', default='analysis',
+        help='Directory to store the analysis results in.')
+    parser.add_argument(
+        '-w', '--workers', type=int,
+        help='Number of worker processes, defaults to the CPU count.')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Analyze every file even if it has not changed.')
+    args = parser.parse_args()
+
+    index = analyze_files(expand_paths(args.paths), args.store,
+                          workers=args.workers, force=args.force)
+    failed = [path for path, entry in index.items() if 'error' in entry]
+    print('{} files analyzed in store "{}".'.format(
+        len(index) - len(failed), args.store))
+    if failed:
+        print('{} files failed:\n  {}'.format(len(failed),
+                                              '\n  '.join(sorted(failed))))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    call_main(main)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Render a set of scores to audio files in parallel.
+
+Scores may be files or paths within the music21 corpus. Each score is
+written to a wav file in the output directory and a manifest.json lists
+the files along with their durations and timings.
+"""
+
+from potty_oh.common import get_cmd_line_parser
+from potty_oh.common import call_main
+from potty_oh.common import ParserArguments
+from potty_oh.common import defaults
+from potty_oh.wav_file import ENCODINGS
+from potty_oh.batch_export import MANIFEST_NAME, export_batch, score_jobs
+
+
+def main():
+    parser = get_cmd_line_parser(description=__doc__)
+    ParserArguments.tempo(parser)
+    ParserArguments.framerate(parser)
+    parser.add_argument(
+        'scores', nargs='+', help='Score files or music21 corpus paths.')
+    parser.add_argument(
+        '-o', '--output', default='renders',
+        help='Directory to write the rendered files to.')
+    parser.add_argument(
+        '-w', '--workers', type=int,
+        help='Number of render processes, defaults to the CPU count.')
+    parser.add_argument(
+        '--writers', type=int, default=2,
+        help='Number of threads writing files.')
+    parser.add_argument(
+        '-e', '--encoding', choices=ENCODINGS, default=ENCODINGS[0],
+        help='Sample encoding of the written files.')
+    ParserArguments.set_defaults(parser)
+    args = parser.parse_args()
+    defaults.framerate = args.framerate
+
+    manifest = export_batch(score_jobs(args.scores, args.tempo), args.output,
+                            workers=args.workers, writers=args.writers,
+                            encoding=args.encoding)
+    exported = [entry for entry in manifest if 'error' not in entry]
+    duration = sum(entry['duration'] for entry in exported)
+    print('Exported {} files ({:.1f} seconds of audio) to "{}".'.format(
+        len(exported), duration, args.output))
+    if len(exported) < len(manifest):
+        print('{} files failed, see "{}".'.format(
+            len(manifest) - len(exported), MANIFEST_NAME))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    call_main(main)
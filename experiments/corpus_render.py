@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""Render many works from the music21 corpus in parallel.
+
+Works are chosen by composer or given as paths and rendered on a pool of
+worker processes. Each work gets its own random seed derived from --seed so
+renders are repeatable. Works that were already rendered into the output
+directory with the same parameters are skipped, so an interrupted run can be
+resumed by running it again.
+"""
+
+from music21 import corpus
+
+from potty_oh.common import get_cmd_line_parser
+from potty_oh.common import call_main
+from potty_oh.common import ParserArguments
+from potty_oh.common import defaults
+from potty_oh.wav_file import ENCODINGS
+from potty_oh.batch_export import export_batch, score_jobs
+
+
+def main():
+    parser = get_cmd_line_parser(description=__doc__)
+    ParserArguments.tempo(parser)
+    ParserArguments.framerate(parser)
+    parser.add_argument(
+        'paths', nargs='*', help='Score files or music21 corpus paths.')
+    parser.add_argument(
+        '-c', '--composer', action='append', default=[],
+        help='Render the corpus works of a composer (may be repeated).')
+    parser.add_argument(
+        '-n', '--limit', type=int,
+        help='Render at most this many works.')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=0,
+        help='Base seed for the per work random generators.')
+    parser.add_argument(
+        '-o', '--output', default='corpus',
+        help='Directory to write the rendered files to.')
+    parser.add_argument(
+        '-w', '--workers', type=int,
+        help='Number of render processes, defaults to the CPU count.')
+    parser.add_argument(
+        '--writers', type=int, default=2,
+        help='Number of threads writing files.')
+    parser.add_argument(
+        '-e', '--encoding', choices=ENCODINGS, default=ENCODINGS[0],
+        help='Sample encoding of the written files.')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Render every work even if it was already rendered.')
+    ParserArguments.set_defaults(parser)
+    args = parser.parse_args()
+    defaults.framerate = args.framerate
+
+    paths = [str(path) for path in args.paths]
+    for composer in args.composer:
+        paths.extend(str(path) for path in corpus.getComposer(composer))
+    if not paths:
+        parser.error('Give some score paths or a --composer.')
+    paths = paths[:args.limit]
+
+    print('Rendering {} works to "{}"...'.format(len(paths), args.output))
+    manifest = export_batch(score_jobs(paths, args.tempo, args.seed),
+                            args.output, workers=args.workers,
+                            writers=args.writers, force=args.force,
+                            encoding=args.encoding)
+    failed = [entry for entry in manifest if 'error' in entry]
+    rendered = [entry for entry in manifest if 'error' not in entry]
+    for entry in rendered:
+        line = ('{filename}: {duration:.1f} seconds rendered in '
+                '{render_seconds:.2f} seconds'.format(**entry))
+        if 'realtime_factor' in entry:
+            line += ' ({:.1f}x realtime)'.format(entry['realtime_factor'])
+        print(line)
+    duration = sum(entry['duration'] for entry in rendered)
+    render_seconds = sum(entry['render_seconds'] for entry in rendered)
+    print('{} works, {:.1f} seconds of audio in {:.1f} render seconds.'.format(
+        len(rendered), duration, render_seconds))
+    for entry in failed:
+        print('{filename}: failed: {error}'.format(**entry))
+    if failed:
+        print('{} works failed and will be retried by the next run.'.format(
+            len(failed)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    call_main(main)
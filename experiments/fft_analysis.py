@@ -21,6 +21,7 @@ from potty_oh.common import ParserArguments
 from potty_oh.common import defaults
 from potty_oh.signal_generator import Generator
 from potty_oh.analysis import analyze_window
+from potty_oh.analysis import spectral_peaks
 
 
 def main():
@@ -29,6 +30,7 @@ def main():
     parser = ParserArguments.plot(parser)
     parser = ParserArguments.framerate(parser)
     parser = ParserArguments.set_defaults(parser)
+    ParserArguments.best(parser)
     args = parser.parse_args()
     defaults.framerate = args.framerate
 
@@ -45,6 +47,13 @@ def main():
     print("Frequency Powers found by FFT: ", frequency_powers)
 
     print('\n0.75 second waveform at 1234Hz')
+    if args.best:
+        frequencies, magnitudes, _ = analyze_window(
+            sig_gen.sin_constant(1234, length=0.75), fast=True)
+        peaks = spectral_peaks(magnitudes, frequencies, count=10)
+        print('The most powerfull frequencies are:\n{}'.format(
+            '\n'.join([str(peak) for peak in peaks])))
+        return 0
     frequency_powers = analyze_window(
         sig_gen.sin_constant(1234, length=0.75))
     tmp = list(frequency_powers.items())
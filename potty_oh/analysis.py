@@ -15,11 +15,1039 @@
 """analysis.py: A library of tools for performing signal analysis tasks."""
 
 from math import sqrt
-from numpy import round, zeros
-from scipy import fftpack, hanning
+from itertools import chain
+from functools import lru_cache
 from collections import OrderedDict
 
+import numpy
+from numpy import round, zeros, hanning
+from numpy.lib.stride_tricks import as_strided
+from scipy import fftpack
+from scipy.fft import rfft, irfft, rfftfreq, next_fast_len
+from scipy.signal import get_window, correlate, firwin, upfirdn, lfilter
+from scipy.sparse import csr_matrix
+
+from potty_oh.common import defaults
 from potty_oh.waveform import Waveform
+from potty_oh.music.pitch import Key
+
+
+def _mono_wavedata(waveform):
+    """Return the (wavedata, framerate) of a waveform as a mono float array.
+
+    Stereo waveforms are mixed down by averaging the channels. Plain arrays
+    are assumed to be at the default framerate.
+    """
+    framerate = defaults.framerate
+    wavedata = waveform
+    if isinstance(waveform, Waveform):
+        framerate = waveform.framerate
+        wavedata = waveform.frames
+    wavedata = numpy.asarray(wavedata, dtype=float)
+    if wavedata.ndim > 1:
+        wavedata = wavedata.mean(axis=1)
+    return wavedata, framerate
+
+
+@lru_cache(maxsize=32)
+def _window(name, size):
+    """Cached, read only window coefficients keyed by window name and size."""
+    coefficients = get_window(name, size)
+    coefficients.flags.writeable = False
+    return coefficients
+
+
+@lru_cache(maxsize=32)
+def _rfft_frequencies(size, framerate):
+    """Cached, read only bin frequencies of a real FFT of the given size."""
+    frequencies = rfftfreq(size, 1.0 / framerate)
+    frequencies.flags.writeable = False
+    return frequencies
+
+
+def window_size_for_precision(framerate, precision=10):
+    """Calculate the analysis window size for a frequency precision in Hz.
+
+    See analyze_whole_waveform for how the precision is calculated.
+    """
+    return int(framerate / 2 / precision)
+
+
+def frame_signal(wavedata, window_size, hop_size):
+    """Split a signal into overlapping frames without copying it.
+
+    Returns a tuple of two (frame count, window_size) arrays: a read only
+    view of every frame that fits inside the signal and a small zero padded
+    array holding the frames that start inside the signal but run past the
+    end of it. Frames start every hop_size frames from the first frame.
+    """
+    wavedata = numpy.ascontiguousarray(wavedata)
+    count = len(wavedata)
+    full_count = 0
+    if count >= window_size:
+        full_count = (count - window_size) // hop_size + 1
+    stride = wavedata.strides[0]
+    frames = as_strided(wavedata, shape=(full_count, window_size),
+                        strides=(hop_size * stride, stride), writeable=False)
+    starts = range(full_count * hop_size, count, hop_size)
+    tail = zeros((len(starts), window_size))
+    for index, start in enumerate(starts):
+        remaining = wavedata[start:start + window_size]
+        tail[index, :len(remaining)] = remaining
+    return frames, tail
+
+
+def _frame_batches(wavedata, window_size, hop_size, batch_size=1024):
+    """Yield (first frame index, frames) for batches of frames of a signal.
+
+    Each batch is a (batch_size, window_size) array (the last may be
+    shorter) so long signals can be processed in bounded memory.
+    """
+    full, tail = frame_signal(wavedata, window_size, hop_size)
+    frame_count = len(full) + len(tail)
+    for start in range(0, frame_count, batch_size):
+        stop = min(start + batch_size, frame_count)
+        yield start, numpy.vstack((full[start:stop],
+                                   tail[max(0, start - len(full)):
+                                        max(0, stop - len(full))]))
+
+
+def stft(waveform, window_size=None, hop_size=None, window='hann',
+         workers=None):
+    """Short Time Fourier Transform of a whole waveform.
+
+    All frames are windowed with a single broadcast multiplication and
+    transformed with one batched real FFT. The window size defaults to the
+    10Hz precision used by analyze_whole_waveform with a hop of half a
+    window. Use workers to run the FFT on multiple threads.
+
+    Returns the tuple: (times, frequencies, spectrum)
+
+    Where times holds the start time in seconds of each frame, frequencies
+    holds the center frequency of each bin and spectrum is a complex array
+    with the shape (len(times), len(frequencies)).
+    """
+    wavedata, framerate = _mono_wavedata(waveform)
+    if not window_size:
+        window_size = window_size_for_precision(framerate)
+    if not hop_size:
+        hop_size = window_size // 2
+    frames, tail = frame_signal(wavedata, window_size, hop_size)
+    coefficients = _window(window, window_size)
+    windowed = numpy.empty((len(frames) + len(tail), window_size))
+    numpy.multiply(frames, coefficients, out=windowed[:len(frames)])
+    numpy.multiply(tail, coefficients, out=windowed[len(frames):])
+    spectrum = rfft(windowed, axis=1, overwrite_x=True, workers=workers)
+    times = numpy.arange(len(windowed)) * hop_size / float(framerate)
+    return times, _rfft_frequencies(window_size, framerate), spectrum
+
+
+def istft(spectrum, window_size, hop_size=None, window='hann',
+          framerate=None, length=None, workers=None):
+    """Resynthesize a waveform from a Short Time Fourier Transform.
+
+    This is the inverse of stft given the same window size, hop and window.
+    All frames are inverted with one batched real FFT, windowed again and
+    overlap-added. The sum is divided by the overlapping squared window so
+    the original signal is recovered wherever the window is non-zero. The
+    result is trimmed to length frames if given.
+
+    Returns a Waveform.
+    """
+    if not framerate:
+        framerate = defaults.framerate
+    if not hop_size:
+        hop_size = window_size // 2
+    frames = irfft(spectrum, window_size, axis=1, workers=workers)
+    coefficients = _window(window, window_size)
+    frames *= coefficients
+    squared = numpy.square(coefficients)
+    count = len(frames)
+    # Add each hop sized column segment of every frame in one vectorized
+    # step, every frame's segment lands hop_size frames after the last.
+    segments = -(-window_size // hop_size)
+    output = zeros((count + segments) * hop_size)
+    norm = zeros(len(output))
+    for segment in range(segments):
+        columns = slice(segment * hop_size,
+                        min((segment + 1) * hop_size, window_size))
+        width = columns.stop - columns.start
+        start = segment * hop_size
+        stop = start + count * hop_size
+        output[start:stop].reshape(count, hop_size)[:, :width] += (
+            frames[:, columns])
+        norm[start:stop].reshape(count, hop_size)[:, :width] += (
+            squared[columns])
+    if length is None:
+        length = max(0, (count - 1) * hop_size + window_size)
+    output = output[:length]
+    norm = norm[:length]
+    numpy.divide(output, norm, out=output,
+                 where=norm > numpy.finfo(float).eps * squared.max())
+    return Waveform(output, framerate)
+
+
+def spectral_filter(waveform, gains, window_size=None, hop_size=None,
+                    window='hann', workers=None):
+    """Filter a waveform by scaling every frame of its STFT.
+
+    The gains may be an array with one gain per frequency bin or a function
+    that is called with the bin frequencies and returns the gains.
+
+    Returns a Waveform the same length as the original.
+    """
+    wavedata, framerate = _mono_wavedata(waveform)
+    if not window_size:
+        window_size = window_size_for_precision(framerate)
+    if not hop_size:
+        hop_size = window_size // 2
+    _, frequencies, spectrum = stft(wavedata, window_size, hop_size, window,
+                                    workers)
+    if callable(gains):
+        gains = gains(frequencies)
+    spectrum *= gains
+    return istft(spectrum, window_size, hop_size, window, framerate,
+                 len(wavedata), workers)
+
+
+class StreamingAnalyzer(object):
+    """Incrementally compute the STFT of a signal that arrives in chunks.
+
+    Chunks of any size may be pushed into the analyzer. Only the overlap
+    needed for the next frame (always less than one window) is kept between
+    calls so memory use does not depend on the length of the signal. Pushing
+    a whole signal followed by a flush gives the same frames as stft.
+    """
+    def __init__(self, framerate=None, window_size=None, hop_size=None,
+                 window='hann', workers=None):
+        self.framerate = framerate
+        if not framerate:
+            self.framerate = defaults.framerate
+        self.window_size = window_size
+        if not window_size:
+            self.window_size = window_size_for_precision(self.framerate)
+        self.hop_size = hop_size
+        if not hop_size:
+            self.hop_size = self.window_size // 2
+        if self.hop_size > self.window_size:
+            raise ValueError('The hop size cannot be larger than a window.')
+        self.window = window
+        self.workers = workers
+        self.frame_count = 0  # frames emitted so far
+        self._overlap = zeros(0)
+
+    @property
+    def frequencies(self):
+        """The center frequency of each bin in the emitted spectra."""
+        return _rfft_frequencies(self.window_size, self.framerate)
+
+    def _analyze(self, frames):
+        """Window and transform a batch of frames."""
+        times = ((self.frame_count + numpy.arange(len(frames))) *
+                 self.hop_size / float(self.framerate))
+        self.frame_count += len(frames)
+        windowed = frames * _window(self.window, self.window_size)
+        spectrum = rfft(windowed, axis=1, overwrite_x=True,
+                        workers=self.workers)
+        return times, spectrum
+
+    def push(self, samples):
+        """Add a chunk of samples and analyze every frame it completes.
+
+        Returns the tuple (times, spectrum) for the completed frames, which
+        may be empty if the chunk did not complete a frame.
+        """
+        samples, _ = _mono_wavedata(samples)
+        data = numpy.concatenate((self._overlap, samples))
+        frames, _ = frame_signal(data, self.window_size, self.hop_size)
+        result = self._analyze(frames)
+        self._overlap = data[len(frames) * self.hop_size:].copy()
+        return result
+
+    def flush(self):
+        """Analyze the zero padded frames left at the end of the signal."""
+        _, tail = frame_signal(self._overlap, self.window_size,
+                               self.hop_size)
+        self._overlap = zeros(0)
+        return self._analyze(tail)
+
+
+def analyze_blocks(blocks, **kwargs):
+    """Yield (times, spectrum) tuples while analyzing an iterable of blocks.
+
+    Keyword arguments are passed to StreamingAnalyzer.
+    """
+    analyzer = StreamingAnalyzer(**kwargs)
+    for block in blocks:
+        times, spectrum = analyzer.push(block)
+        if len(times):
+            yield times, spectrum
+    times, spectrum = analyzer.flush()
+    if len(times):
+        yield times, spectrum
+
+
+PEAK_DTYPE = numpy.dtype([('frequency', float), ('magnitude', float),
+                         ('bin', float)])
+
+
+def spectral_peaks(spectrum, frequencies, count=5):
+    """Find the strongest peaks in each frame of a magnitude spectrum.
+
+    The spectrum may be a single frame or a (frames, bins) array as returned
+    by stft; complex spectra are converted to magnitudes. Only local maxima
+    are considered peaks and their frequency and magnitude are refined with
+    parabolic interpolation of the log magnitudes.
+
+    Returns a structured array of PEAK_DTYPE with the shape (frames, count)
+    (or (count,) for a single frame) sorted from strongest to weakest. Frames
+    with fewer than count peaks are padded with zero magnitude entries whose
+    frequency and bin are NaN.
+    """
+    magnitudes = numpy.abs(numpy.asarray(spectrum))
+    single = magnitudes.ndim == 1
+    magnitudes = numpy.atleast_2d(magnitudes)
+    frequencies = numpy.asarray(frequencies, dtype=float)
+    count = min(count, magnitudes.shape[1])
+
+    maxima = zeros(magnitudes.shape)
+    is_peak = ((magnitudes[:, 1:-1] > magnitudes[:, :-2]) &
+               (magnitudes[:, 1:-1] >= magnitudes[:, 2:]))
+    maxima[:, 1:-1] = numpy.where(is_peak, magnitudes[:, 1:-1], 0.0)
+
+    rows = numpy.arange(len(maxima))[:, numpy.newaxis]
+    top = numpy.argpartition(maxima, -count, axis=1)[:, -count:]
+    order = numpy.argsort(maxima[rows, top], axis=1)[:, ::-1]
+    bins = top[rows, order]
+    strength = maxima[rows, bins]
+    found = strength > 0
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        before = numpy.log(magnitudes[rows, numpy.maximum(bins - 1, 0)])
+        at = numpy.log(magnitudes[rows, bins])
+        after = numpy.log(magnitudes[rows, numpy.minimum(
+            bins + 1, magnitudes.shape[1] - 1)])
+        curvature = before - 2 * at + after
+        # a zero magnitude neighbour has no log so its peak isn't refined
+        refine = (found & numpy.isfinite(before) & numpy.isfinite(at) &
+                  numpy.isfinite(after) & (curvature < 0))
+        shift = numpy.where(refine, 0.5 * (before - after) / curvature, 0.0)
+        shift = numpy.clip(shift, -0.5, 0.5)
+        refined = numpy.where(
+            refine, numpy.exp(at - 0.25 * (before - after) * shift),
+            magnitudes[rows, bins])
+
+    peaks = numpy.zeros(bins.shape, dtype=PEAK_DTYPE)
+    peaks['bin'] = numpy.where(found, bins + shift, numpy.nan)
+    spacing = frequencies[1] - frequencies[0]
+    peaks['frequency'] = frequencies[0] + peaks['bin'] * spacing
+    peaks['magnitude'] = numpy.where(found, refined, 0.0)
+    return peaks[0] if single else peaks
+
+
+def _yin_cmndf(frames, max_lag, workers=None):
+    """Cumulative mean normalized difference function for a batch of frames.
+
+    The difference function of YIN is expanded into the energy terms and an
+    autocorrelation term so the whole batch needs one pair of real FFTs.
+    """
+    span = frames.shape[1] - max_lag  # length of the integration window
+    size = next_fast_len(frames.shape[1] + span)
+    correlation = irfft(
+        rfft(frames, size, axis=1, workers=workers) *
+        numpy.conj(rfft(frames[:, :span], size, axis=1, workers=workers)),
+        size, axis=1, workers=workers)[:, :max_lag]
+    energy = numpy.cumsum(numpy.square(frames), axis=1)
+    energy = numpy.hstack((zeros((len(frames), 1)), energy))
+    lags = numpy.arange(max_lag)
+    difference = (energy[:, span:span + 1] + energy[:, lags + span] -
+                  energy[:, lags] - 2 * correlation)
+    cmndf = numpy.ones_like(difference)
+    running_mean = numpy.cumsum(difference[:, 1:], axis=1) / lags[1:]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        cmndf[:, 1:] = numpy.where(running_mean > 0,
+                                   difference[:, 1:] / running_mean, 1.0)
+    return cmndf
+
+
+def track_pitch(waveform, min_frequency=50.0, max_frequency=2000.0,
+                window_size=None, hop_size=None, threshold=0.1,
+                batch_size=1024, workers=None):
+    """Estimate the fundamental frequency of each frame with YIN.
+
+    The window size defaults to two periods of min_frequency and the hop to
+    a quarter window. Frames are processed in batches of batch_size frames
+    at a time to bound memory use on long signals.
+
+    Returns the tuple: (times, frequencies, confidence)
+
+    Confidence is in the range 0 to 1, frames without a clear pitch (such
+    as silence) have a low confidence.
+    """
+    wavedata, framerate = _mono_wavedata(waveform)
+    max_lag = int(numpy.ceil(framerate / float(min_frequency))) + 2
+    if not window_size:
+        window_size = 2 * max_lag
+    if not hop_size:
+        hop_size = window_size // 4
+    max_lag = min(max_lag, window_size // 2)
+    min_lag = max(1, int(framerate / float(max_frequency)))
+    lags = []
+    confidence = []
+    for _, frames in _frame_batches(wavedata, window_size, hop_size,
+                                    batch_size):
+        cmndf = _yin_cmndf(frames, max_lag, workers)
+        search = cmndf[:, min_lag:max_lag - 1]
+        # the first dip below the threshold, else the global minimum
+        candidates = ((search < threshold) &
+                      (search <= cmndf[:, min_lag + 1:max_lag]))
+        best = numpy.where(candidates.any(axis=1),
+                           numpy.argmax(candidates, axis=1),
+                           numpy.argmin(search, axis=1)) + min_lag
+        rows = numpy.arange(len(frames))
+        # parabolic interpolation for sub-sample lag precision
+        before = cmndf[rows, numpy.maximum(best - 1, 0)]
+        at = cmndf[rows, best]
+        after = cmndf[rows, numpy.minimum(best + 1, max_lag - 1)]
+        curvature = before - 2 * at + after
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            shift = numpy.where(curvature > 0,
+                                0.5 * (before - after) / curvature, 0.0)
+        lags.append(best + numpy.clip(shift, -1.0, 1.0))
+        confidence.append(numpy.clip(1.0 - at, 0.0, 1.0))
+    lags = numpy.concatenate(lags) if lags else zeros(0)
+    confidence = numpy.concatenate(confidence) if confidence else zeros(0)
+    times = numpy.arange(len(lags)) * hop_size / float(framerate)
+    return times, framerate / lags, confidence
+
+
+def key_frequencies(key=None, octaves=range(-4, 5)):
+    """Calculate the frequency of every semitone of a Key over some octaves.
+
+    Returns the tuple: (frequencies, semitones, octaves)
+
+    The arrays are sorted by frequency so that
+    ``key.interval(semitones[i], octaves[i]) == frequencies[i]``.
+    """
+    if key is None:
+        key = Key()
+    notes = [(key.interval(semitone, octave), semitone, octave)
+             for octave in octaves for semitone in range(12)]
+    notes.sort()
+    frequencies, semitones, octaves = zip(*notes)
+    return (numpy.array(frequencies), numpy.array(semitones),
+            numpy.array(octaves))
+
+
+def nearest_key_intervals(frequencies, key=None, octaves=range(-4, 5)):
+    """Map frequencies to the nearest note of a Key.
+
+    Returns the tuple: (semitones, octaves, cents)
+
+    Where ``key.interval(semitones[i], octaves[i])`` is the note nearest to
+    frequencies[i] and cents is the deviation from that note. Frequencies
+    that are not positive map to semitone -1 with a NaN deviation.
+    """
+    note_frequencies, note_semitones, note_octaves = key_frequencies(
+        key, octaves)
+    frequencies = numpy.asarray(frequencies, dtype=float)
+    valid = frequencies > 0
+    log_notes = numpy.log2(note_frequencies)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        log_frequencies = numpy.log2(numpy.where(valid, frequencies, 1.0))
+    upper = numpy.clip(numpy.searchsorted(log_notes, log_frequencies),
+                       1, len(log_notes) - 1)
+    nearest = numpy.where(
+        log_frequencies - log_notes[upper - 1] <
+        log_notes[upper] - log_frequencies, upper - 1, upper)
+    cents = 1200 * (log_frequencies - log_notes[nearest])
+    return (numpy.where(valid, note_semitones[nearest], -1),
+            numpy.where(valid, note_octaves[nearest], 0),
+            numpy.where(valid, cents, numpy.nan))
+
+
+@lru_cache(maxsize=8)
+def _constant_q_kernel(frequencies, framerate, threshold):
+    """Build the sparse spectral kernel of a constant-Q transform.
+
+    Following Brown and Puckette, each row is the FFT of a windowed complex
+    sinusoid whose length gives a constant ratio of frequency to bandwidth
+    of one semitone. Values below threshold times the row peak are dropped.
+
+    Returns the tuple: (kernel, window_size)
+    """
+    quality = 1.0 / (pow(2, 1.0 / 12) - 1)
+    lengths = numpy.ceil(
+        quality * framerate / numpy.array(frequencies)).astype(int)
+    window_size = int(pow(2, numpy.ceil(numpy.log2(lengths.max()))))
+    temporal = zeros((len(frequencies), window_size), dtype=complex)
+    for row, (frequency, length) in enumerate(zip(frequencies, lengths)):
+        start = (window_size - length) // 2
+        temporal[row, start:start + length] = (
+            numpy.hamming(length) / length *
+            numpy.exp(2j * numpy.pi * frequency * numpy.arange(length) /
+                      framerate))
+    spectral = numpy.fft.fft(temporal, axis=1)[:, :window_size // 2 + 1]
+    peaks = numpy.abs(spectral).max(axis=1)[:, numpy.newaxis]
+    spectral[numpy.abs(spectral) < threshold * peaks] = 0
+    return csr_matrix(numpy.conj(spectral) / window_size), window_size
+
+
+class ConstantQ(object):
+    """A constant-Q transform with one bin per semitone of a musical Key.
+
+    Bin centers come from Key.interval so any Temperament can be analyzed,
+    either through the key or the temperament argument. Kernels are cached
+    so each frame costs one real FFT and one sparse matrix product.
+    """
+    def __init__(self, key=None, temperament=None, octaves=range(-3, 3),
+                 framerate=None, hop_size=None, threshold=0.0054,
+                 workers=None):
+        if key is None:
+            key = Key()
+        if temperament is not None:
+            key = Key(key.root_frequency, key.root_name, temperament)
+        self.key = key
+        self.framerate = framerate
+        if not framerate:
+            self.framerate = defaults.framerate
+        frequencies, semitones, octaves = key_frequencies(key, octaves)
+        audible = frequencies < self.framerate / 2.0
+        self.frequencies = frequencies[audible]
+        self.semitones = semitones[audible]
+        self.octaves = octaves[audible]
+        self.kernel, self.window_size = _constant_q_kernel(
+            tuple(self.frequencies), self.framerate, threshold)
+        self.hop_size = hop_size
+        if not hop_size:
+            self.hop_size = self.window_size // 4
+        self.workers = workers
+
+    def transform(self, waveform, batch_size=256):
+        """Calculate the constant-Q transform of a whole waveform.
+
+        Returns the tuple: (times, frequencies, coefficients)
+
+        Where coefficients is a complex (len(times), len(frequencies))
+        array.
+        """
+        wavedata, _ = _mono_wavedata(waveform)
+        coefficients = [
+            (self.kernel @ rfft(frames, axis=1, workers=self.workers).T).T
+            for _, frames in _frame_batches(wavedata, self.window_size,
+                                            self.hop_size, batch_size)]
+        if coefficients:
+            coefficients = numpy.vstack(coefficients)
+        else:
+            coefficients = zeros((0, len(self.frequencies)), dtype=complex)
+        times = (numpy.arange(len(coefficients)) * self.hop_size /
+                 float(self.framerate))
+        return times, self.frequencies, coefficients
+
+    def chroma(self, waveform, normalize=True):
+        """Fold the constant-Q magnitudes into the 12 semitones of the key.
+
+        Returns the tuple: (times, chroma)
+
+        Where chroma has the shape (len(times), 12) and column i holds the
+        energy of semitone i above the key's root in every octave. With
+        normalize each frame is scaled so its strongest semitone is 1.
+        """
+        times, _, coefficients = self.transform(waveform)
+        folding = numpy.eye(12)[self.semitones]
+        chroma = numpy.abs(coefficients) @ folding
+        if normalize:
+            peaks = chroma.max(axis=1, initial=0)[:, numpy.newaxis]
+            chroma = numpy.divide(chroma, peaks, out=zeros(chroma.shape),
+                                  where=peaks > 0)
+        return times, chroma
+
+
+@lru_cache(maxsize=16)
+def _goertzel_basis(frequencies, window_size, framerate, window):
+    """Windowed cosine and sine basis for a set of target frequencies.
+
+    The columns hold the cosine terms followed by the sine terms so both
+    can be evaluated for every frame with a single matrix product.
+    """
+    angles = (2 * numpy.pi * numpy.arange(window_size)[:, numpy.newaxis] *
+              numpy.array(frequencies)[numpy.newaxis, :] / framerate)
+    coefficients = _window(window, window_size)[:, numpy.newaxis]
+    basis = numpy.hstack((numpy.cos(angles), numpy.sin(angles)))
+    basis *= coefficients
+    basis.flags.writeable = False
+    return basis
+
+
+def goertzel(waveform, frequencies, window_size=None, hop_size=None,
+             window='hann', batch_size=1024, octaves=(0,)):
+    """Measure the strength of a small set of target frequencies per frame.
+
+    Each target is evaluated like a Goertzel filter: a single DFT term at
+    exactly the target frequency rather than at the nearest FFT bin. All
+    frames and targets are evaluated together as one matrix product per
+    batch. The frequencies may also be a Key, in which case the 12
+    semitones of the key in each of the given octaves (below the Nyquist
+    frequency) are measured.
+
+    The cost grows linearly with the number of targets while the STFT cost
+    doesn't depend on it, so this is only cheaper than stft for a small set
+    of targets. The crossover depends on the BLAS library but is usually
+    somewhere between one and a few dozen targets: measure a single octave
+    of a Key rather than all nine.
+
+    Returns the tuple: (times, frequencies, magnitudes)
+
+    Where magnitudes has the shape (len(times), len(frequencies)) and uses
+    the same scale as the stft magnitudes.
+    """
+    wavedata, framerate = _mono_wavedata(waveform)
+    if isinstance(frequencies, Key):
+        frequencies = key_frequencies(frequencies, octaves)[0]
+        frequencies = frequencies[frequencies < framerate / 2.0]
+    frequencies = numpy.asarray(frequencies, dtype=float)
+    if not window_size:
+        window_size = window_size_for_precision(framerate)
+    if not hop_size:
+        hop_size = window_size // 2
+    basis = _goertzel_basis(tuple(frequencies), window_size, framerate,
+                            window)
+    magnitudes = []
+    for _, frames in _frame_batches(wavedata, window_size, hop_size,
+                                    batch_size):
+        terms = frames @ basis
+        magnitudes.append(numpy.hypot(terms[:, :len(frequencies)],
+                                      terms[:, len(frequencies):]))
+    if magnitudes:
+        magnitudes = numpy.vstack(magnitudes)
+    else:
+        magnitudes = zeros((0, len(frequencies)))
+    times = numpy.arange(len(magnitudes)) * hop_size / float(framerate)
+    return times, frequencies, magnitudes
+
+
+# the fraction of a decimated level's framerate below its filter's roll off
+_DECIMATED_PASSBAND = 0.4
+
+
+@lru_cache(maxsize=8)
+def _decimation_filter(taps):
+    """Cached half band anti-alias low pass filter for halving the framerate.
+
+    Every second coefficient of a half band filter is zero except the
+    center one which lets decimate skip them.
+    """
+    if taps % 4 != 1:
+        raise ValueError('Decimation filters need 4n+1 taps so their delay '
+                         'is a whole number of output frames.')
+    coefficients = firwin(taps, 0.5)
+    coefficients.flags.writeable = False
+    return coefficients
+
+
+def decimate(wavedata, taps=49):
+    """Low pass filter a signal and drop every second frame.
+
+    Only the filter outputs that are kept are calculated, and the zero
+    coefficients of the half band filter are skipped, so filtering costs
+    about a quarter of the taps per input frame. The filter delay is removed
+    so the result stays aligned in time with the original signal.
+    """
+    delay = (taps - 1) // 4
+    coefficients = _decimation_filter(taps)
+    wavedata = numpy.asarray(wavedata, dtype=float)
+    # even frames only meet the center coefficient, odd frames the odd ones
+    decimated = coefficients[2 * delay] * wavedata[0::2]
+    if len(wavedata) > 1:
+        odd = numpy.convolve(numpy.ascontiguousarray(wavedata[1::2]),
+                             coefficients[1::2])
+        decimated += odd[delay - 1:delay - 1 + len(decimated)]
+    return decimated
+
+
+def multirate_stft(waveform, min_frequency=55.0, precision=1.0,
+                   taps=49, workers=None):
+    """Analyze each octave band at the lowest framerate that can hold it.
+
+    The signal is repeatedly decimated by two to build a pyramid and every
+    level is transformed with the same FFT size, sized so the lowest band
+    has the given precision in Hz (see analyze_whole_waveform). Each octave
+    up has twice the bin spacing, so every band has the same precision
+    relative to its frequencies, like a constant Q transform. Halving the
+    framerate halves the work so the whole pyramid costs less than twice
+    the full framerate level and its decimation. That is still a few times
+    the cost of a single stft, which is limited by memory rather than FFT
+    size, in exchange for the finer low frequency precision.
+
+    Each level reports the octave below its decimation filter's roll off
+    (up to 0.4 times its framerate, or Nyquist for the top level), starting
+    just above the highest frequency of the band below, so the bands cover
+    0 Hz to Nyquist without overlapping. The last level also covers every
+    frequency below min_frequency. The levels have different hop sizes so
+    the frame times are not shared between bands.
+
+    Returns a list of (framerate, times, frequencies, spectrum) tuples from
+    the highest band to the lowest. Each tuple is like the stft result
+    limited to the frequencies of the band.
+    """
+    wavedata, framerate = _mono_wavedata(waveform)
+    levels = 1
+    while (_DECIMATED_PASSBAND * framerate / pow(2, levels) >
+           min_frequency):
+        levels += 1
+    window_size = next_fast_len(max(2, window_size_for_precision(
+        framerate / pow(2, levels - 1), precision)), True)
+    spectra = []
+    for level in range(levels):
+        spectra.append((framerate,) + stft(
+            Waveform(wavedata, framerate), window_size, window_size // 2,
+            workers=workers))
+        if level < levels - 1:
+            wavedata = decimate(wavedata, taps)
+            framerate = framerate / 2.0
+
+    bands = []
+    low = -1.0  # the highest frequency of the band below
+    for level, (framerate, times, frequencies, spectrum) in reversed(
+            list(enumerate(spectra))):
+        band = frequencies > low
+        if level:
+            band &= frequencies <= _DECIMATED_PASSBAND * framerate
+        bands.append((framerate, times, frequencies[band],
+                      spectrum[:, band]))
+        low = frequencies[band].max()
+    return bands[::-1]
+
+
+def _refine_peak(values, index):
+    """Parabolic interpolation of a peak position, in fractional indexes."""
+    if index <= 0 or index >= len(values) - 1:
+        return float(index)
+    before, at, after = values[index - 1], values[index], values[index + 1]
+    curvature = before - 2 * at + after
+    if curvature >= 0:
+        return float(index)
+    return index + 0.5 * (before - after) / curvature
+
+
+def cross_correlate(first, second, workers=None):
+    """Cross-correlate two signals using real FFTs.
+
+    Returns the tuple: (lags, correlation)
+
+    Where ``correlation[i]`` is the sum of ``first[n + lags[i]] * second[n]``
+    over all n. A peak at a positive lag means first is a delayed copy of
+    second.
+    """
+    first, _ = _mono_wavedata(first)
+    second, _ = _mono_wavedata(second)
+    size = next_fast_len(len(first) + len(second) - 1)
+    circular = irfft(rfft(first, size, workers=workers) *
+                     numpy.conj(rfft(second, size, workers=workers)),
+                     size, workers=workers)
+    correlation = numpy.concatenate(
+        (circular[size - len(second) + 1:], circular[:len(first)]))
+    lags = numpy.arange(-(len(second) - 1), len(first))
+    return lags, correlation
+
+
+def estimate_lag(first, second, max_lag=None, workers=None):
+    """Estimate how many frames first lags behind second.
+
+    The lag is refined to a fraction of a frame by parabolic interpolation
+    of the correlation peak. Use max_lag to limit the search to lags within
+    that many frames.
+    """
+    lags, correlation = cross_correlate(first, second, workers)
+    if max_lag is not None:
+        within = numpy.abs(lags) <= max_lag
+        lags, correlation = lags[within], correlation[within]
+    peak = int(numpy.argmax(correlation))
+    return lags[0] + _refine_peak(correlation, peak)
+
+
+def align(reference, other, max_lag=None, workers=None):
+    """Shift other so that it lines up with reference.
+
+    The shift is applied as a linear phase in the frequency domain so
+    fractional lags don't smear the signal the way interpolation would.
+
+    Returns a Waveform the same length as the reference.
+    """
+    wavedata, framerate = _mono_wavedata(other)
+    reference, _ = _mono_wavedata(reference)
+    lag = estimate_lag(wavedata, reference, max_lag, workers)
+    # pad so the shifted signal does not wrap around
+    size = next_fast_len(max(len(wavedata), len(reference)) +
+                         int(numpy.ceil(abs(lag))))
+    spectrum = rfft(wavedata, size, workers=workers)
+    spectrum *= numpy.exp(2j * numpy.pi * numpy.arange(len(spectrum)) *
+                          lag / size)
+    shifted = irfft(spectrum, size, workers=workers)[:len(reference)]
+    return Waveform(shifted, framerate)
+
+
+class StreamingCorrelator(object):
+    """Accumulate the cross-correlation of two long signals block by block.
+
+    Only lags within max_lag frames are tracked so memory use depends on
+    max_lag and the block size instead of the length of the signals. Blocks
+    of first and second should be pushed together as they are read.
+    """
+    def __init__(self, max_lag):
+        self.max_lag = int(max_lag)
+        self.lags = numpy.arange(-self.max_lag, self.max_lag + 1)
+        self.correlation = zeros(len(self.lags))
+        # first holds the frames from max_lag before the next second frame
+        self._first = zeros(self.max_lag)
+        self._second = zeros(0)
+
+    def _correlate(self, count):
+        """Add the contribution of the next count frames of second."""
+        span = self._first[:count + 2 * self.max_lag]
+        self.correlation += correlate(span, self._second[:count],
+                                      mode='valid', method='fft')
+        self._first = self._first[count:]
+        self._second = self._second[count:]
+
+    def push(self, first, second):
+        """Add the next blocks of both signals."""
+        first, _ = _mono_wavedata(first)
+        second, _ = _mono_wavedata(second)
+        self._first = numpy.concatenate((self._first, first))
+        self._second = numpy.concatenate((self._second, second))
+        count = min(len(self._second), len(self._first) - 2 * self.max_lag)
+        if count > 0:
+            self._correlate(count)
+
+    def finish(self):
+        """Process the frames left once both signals have ended."""
+        if len(self._second):
+            self._first = numpy.concatenate(
+                (self._first, zeros(len(self._second) + 2 * self.max_lag -
+                                    len(self._first))))
+            self._correlate(len(self._second))
+
+    @property
+    def lag(self):
+        """The estimated lag of first behind second in frames."""
+        peak = int(numpy.argmax(self.correlation))
+        return self.lags[0] + _refine_peak(self.correlation, peak)
+
+
+class Meter(object):
+    """Base class for level meters that measure a signal block by block.
+
+    Meters accept mono blocks or (frames, channels) blocks and also provide
+    write_frames so they can be used wherever a wav file is written to.
+    """
+    def update(self, block):
+        """Measure the next block of the signal."""
+        raise NotImplementedError()
+
+    def write_frames(self, block):
+        self.update(block)
+        return len(block)
+
+    @staticmethod
+    def _block(block):
+        """Return the block as a float array with one column per channel."""
+        if isinstance(block, Waveform):
+            block = block.frames
+        block = numpy.asarray(block, dtype=float)
+        if block.ndim == 1:
+            block = block[:, numpy.newaxis]
+        return block
+
+
+class PeakMeter(Meter):
+    """Track the largest absolute sample value and count clipped samples."""
+    def __init__(self, clip_level=1.0):
+        self.clip_level = clip_level
+        self.peak = 0.0
+        self.clipped = 0
+
+    def update(self, block):
+        block = numpy.abs(self._block(block))
+        if block.size:
+            self.peak = max(self.peak, float(block.max()))
+        self.clipped += int(numpy.count_nonzero(block >= self.clip_level))
+
+    @property
+    def peak_db(self):
+        """The peak level in decibels relative to full scale."""
+        with numpy.errstate(divide='ignore'):
+            return 20 * numpy.log10(self.peak)
+
+
+class RMSMeter(Meter):
+    """Track the root mean square level of the whole signal."""
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, block):
+        block = self._block(block)
+        self.total += float(numpy.einsum('ij,ij->', block, block))
+        self.count += block.size
+
+    @property
+    def rms(self):
+        return sqrt(self.total / self.count) if self.count else 0.0
+
+    @property
+    def rms_db(self):
+        """The RMS level in decibels relative to full scale."""
+        with numpy.errstate(divide='ignore'):
+            return 20 * numpy.log10(self.rms)
+
+
+@lru_cache(maxsize=4)
+def _oversampling_filter(factor, taps_per_phase=12):
+    """Cached interpolation filter for oversampling by factor."""
+    coefficients = firwin(factor * taps_per_phase, 1.0 / factor) * factor
+    coefficients.flags.writeable = False
+    return coefficients
+
+
+class TruePeakMeter(PeakMeter):
+    """Estimate the peak of the reconstructed analog signal.
+
+    Blocks are oversampled with a polyphase interpolation filter so peaks
+    between samples are found. The end of each block is kept as filter
+    history for the next block. Clipped samples are counted in the
+    oversampled signal.
+    """
+    def __init__(self, oversample=4, clip_level=1.0):
+        super(TruePeakMeter, self).__init__(clip_level)
+        self.oversample = oversample
+        self.filter = _oversampling_filter(oversample)
+        self._history = None
+
+    def update(self, block):
+        block = self._block(block)
+        if self._history is None:
+            self._history = zeros((-(-len(self.filter) // self.oversample),
+                                   block.shape[1]))
+        data = numpy.vstack((self._history, block))
+        start = len(self._history) * self.oversample
+        upsampled = upfirdn(self.filter, data, up=self.oversample, axis=0)
+        super(TruePeakMeter, self).update(
+            upsampled[start:start + len(block) * self.oversample])
+        self._history = data[len(data) - len(self._history):]
+
+
+def _biquad_high_shelf(framerate, frequency, gain, quality):
+    """Biquad (b, a) coefficients of a high shelf filter."""
+    amplitude = pow(10, gain / 40.0)
+    omega = 2 * numpy.pi * frequency / framerate
+    alpha = numpy.sin(omega) / (2 * quality)
+    cos, root = numpy.cos(omega), 2 * sqrt(amplitude) * alpha
+    b = [amplitude * ((amplitude + 1) + (amplitude - 1) * cos + root),
+         -2 * amplitude * ((amplitude - 1) + (amplitude + 1) * cos),
+         amplitude * ((amplitude + 1) + (amplitude - 1) * cos - root)]
+    a = [(amplitude + 1) - (amplitude - 1) * cos + root,
+         2 * ((amplitude - 1) - (amplitude + 1) * cos),
+         (amplitude + 1) - (amplitude - 1) * cos - root]
+    return numpy.array(b) / a[0], numpy.array(a) / a[0]
+
+
+def _biquad_high_pass(framerate, frequency, quality):
+    """Biquad (b, a) coefficients of a high pass filter."""
+    omega = 2 * numpy.pi * frequency / framerate
+    alpha = numpy.sin(omega) / (2 * quality)
+    cos = numpy.cos(omega)
+    b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+    a = [1 + alpha, -2 * cos, 1 - alpha]
+    return numpy.array(b) / a[0], numpy.array(a) / a[0]
+
+
+class LoudnessMeter(Meter):
+    """Integrated loudness in LUFS following ITU-R BS.1770.
+
+    The signal is K-weighted (a high shelf followed by a high pass filter,
+    designed for the framerate) with the filter state carried between
+    blocks. Mean squares are kept for every 100ms step and combined into
+    gated 400ms blocks with 75% overlap when the loudness is requested,
+    so memory grows by one number per 100ms of signal.
+    """
+    absolute_gate = -70.0  # LUFS
+    relative_gate = -10.0  # LU
+
+    def __init__(self, framerate=None):
+        self.framerate = framerate
+        if not framerate:
+            self.framerate = defaults.framerate
+        self.filters = [
+            _biquad_high_shelf(self.framerate, 1500.0, 4.0, 1 / sqrt(2)),
+            _biquad_high_pass(self.framerate, 38.0, 0.5)]
+        self.step = int(round(self.framerate * 0.1))
+        self._states = None
+        self._partial = zeros(0)
+        self.steps = []  # mean square of each 100ms step
+
+    def update(self, block):
+        block = self._block(block)
+        if self._states is None:
+            self._states = [zeros((2, block.shape[1]))
+                            for _ in self.filters]
+        for index, (b, a) in enumerate(self.filters):
+            block, self._states[index] = lfilter(
+                b, a, block, axis=0, zi=self._states[index])
+        # channel weights are all 1 for mono and stereo signals
+        energy = numpy.concatenate(
+            (self._partial, numpy.square(block).sum(axis=1)))
+        whole = len(energy) // self.step * self.step
+        self.steps.extend(
+            energy[:whole].reshape(-1, self.step).mean(axis=1))
+        self._partial = energy[whole:]
+
+    @staticmethod
+    def _lufs(energy):
+        with numpy.errstate(divide='ignore'):
+            return -0.691 + 10 * numpy.log10(energy)
+
+    @property
+    def blocks(self):
+        """The mean square of each 400ms gating block."""
+        steps = numpy.array(self.steps)
+        if len(steps) < 4:
+            return zeros(0)
+        return (steps[:-3] + steps[1:-2] + steps[2:-1] + steps[3:]) / 4.0
+
+    @property
+    def momentary(self):
+        """The loudness of the most recent 400ms in LUFS."""
+        blocks = self.blocks
+        return self._lufs(blocks[-1]) if len(blocks) else -numpy.inf
+
+    @property
+    def integrated(self):
+        """The gated loudness of the whole signal so far in LUFS."""
+        blocks = self.blocks
+        blocks = blocks[self._lufs(blocks) > self.absolute_gate]
+        if not len(blocks):
+            return -numpy.inf
+        gate = self._lufs(blocks.mean()) + self.relative_gate
+        return self._lufs(blocks[self._lufs(blocks) > gate].mean())
+
+
+class MeteredWriter(object):
+    """Measure blocks with some meters on their way to a wav file.
+
+    The writer can be used in place of the wrapped file object.
+    """
+    def __init__(self, sndfile, *meters):
+        self.sndfile = sndfile
+        self.meters = meters
+
+    def write_frames(self, block):
+        for meter in self.meters:
+            meter.update(block)
+        return self.sndfile.write_frames(block)
+
+    def __getattr__(self, name):
+        return getattr(self.sndfile, name)
 
 
 def analyze_whole_waveform(waveform):
@@ -37,26 +1065,31 @@ def analyze_whole_waveform(waveform):
     - 2205 Frames at 44.1K Frames/sec
     """
     desired_precision = 10  # Hz
-    window_size = int(waveform.framerate / 2 / desired_precision)
+    window_size = window_size_for_precision(waveform.framerate,
+                                            desired_precision)
     hanning_window = hanning(window_size)
+    hop_size = int((len(hanning_window) / 2) - 1)
+    # Do I need to add a first frame case to start with half a window to
+    # match the half window at the end of stream?
+    frames, tail = frame_signal(waveform.frames, window_size, hop_size)
     spectrum = OrderedDict()
-    for start_frame in range(0, len(waveform.frames),
-                             int((len(hanning_window) / 2) - 1)):
-        window = zeros(len(hanning_window))
-        # Do I need to add a first frame case to start with half a window to
-        # match the half window at the end of stream?
-        for frame in range(len(window)):
-            if start_frame + frame < len(waveform.frames):
-                window[frame] = (hanning_window[frame] *
-                                 waveform.frames[start_frame + frame])
-            else:
-                window[frame] = 0
-        spectrum[start_frame] = analyze_window(Waveform(window))
+    for index, frame in enumerate(chain(frames, tail)):
+        spectrum[index * hop_size] = analyze_window(
+            Waveform(hanning_window * frame, waveform.framerate))
     return spectrum
 
 
-def analyze_window(waveform):
-    """"""
+def analyze_window(waveform, fast=False, workers=None):
+    """Analyze the frequency content of a single window.
+
+    By default an OrderedDict mapping each frequency with non-zero power to
+    the tuple (strength, coefficient) is returned. With fast=True the tuple
+    of arrays (frequencies, magnitudes, phases) is returned instead.
+    """
+    if fast:
+        frequencies, magnitudes, coefficients = do_fft(
+            waveform, fast=True, workers=workers)
+        return frequencies, magnitudes, numpy.angle(coefficients)
     frequencies, power_domain, frequency_domain = do_fft(waveform)
     spectrum = OrderedDict()
     for freq, strength, coef in zip(frequencies, power_domain,
@@ -66,14 +1099,22 @@ def analyze_window(waveform):
     return spectrum
 
 
-def do_fft(waveform):
+def do_fft(waveform, fast=False, workers=None):
     """Perform an FFT on the waveform.
 
     Returns the tuple: (frequencies, power_domain, frequency_domain)
+
+    The fast mode uses a real input FFT which only computes the non-negative
+    frequencies, optionally on multiple worker threads, and skips rounding
+    the power values.
     """
+    if fast:
+        wavedata, framerate = _mono_wavedata(waveform)
+        frequency_domain = rfft(wavedata, workers=workers)
+        return (_rfft_frequencies(len(wavedata), framerate),
+                numpy.abs(frequency_domain), frequency_domain)
     frequency_coefficients = fftpack.fft(waveform.frames)
-    power_coefficients = [sqrt(pow(x.real, 2) + pow(x.imag, 2))
-                          for x in frequency_coefficients]
+    power_coefficients = numpy.abs(frequency_coefficients)
     bins = int(len(power_coefficients)/2)
     power_domain = round(power_coefficients[:bins])
     frequency_domain = frequency_coefficients[:bins]
@@ -14,66 +14,203 @@
 
 """A library for turning music21 streams into audio... Audifying."""
 
+import numpy
+
+from .common import defaults
 from .waveform import Waveform
 from .waveform import quarter_note_length
 from .waveform import seconds_to_frame
 from .signal_generator import Generator
 from .signal_generator import PhasorGenerator
-from .wav_file import wav_file_context
+from .wav_file import ThreadedWriter
+
+
+def _score_notes(score):
+    """List the (offset, quarter length, pitch, frequency) of each note.
+
+    The score may be a music21 score or a note array from
+    potty_oh.score_cache, which doesn't keep pitch names so the part is
+    given instead.
+    """
+    if isinstance(score, numpy.ndarray):
+        return [(note['onset'], note['duration'],
+                 'part {}'.format(note['part']), note['frequency'])
+                for note in score]
+    return [(note.offset, note.quarterLength, note.pitch,
+             note.pitch.frequency) for note in score.flat.notes]
 
 
 def audify_basic(score, tempo, verbose=False):
-    """Audify a music21 score using the basic signal generater."""
+    """Audify a music21 score or note array with the basic generater."""
     sig_gen = Generator(verbose)
     song = Waveform([])
     qnl = quarter_note_length(tempo)
 
-    notes = score.flat.notes
+    notes = _score_notes(score)
     note_count = len(notes)
     try:
-        for count, note in enumerate(notes):
+        for count, (offset, length, pitch, frequency) in enumerate(notes):
             print('{}/{}: {} [{}]: {} {}'.format(
-                count, note_count, note.offset, note.duration.quarterLength,
-                note.pitch, note.pitch.frequency))
-            note_length = qnl * note.quarterLength
-            start = seconds_to_frame(qnl * note.offset)
+                count, note_count, offset, length, pitch, frequency))
+            note_length = qnl * length
+            start = seconds_to_frame(qnl * offset)
             print('  inserting {} seconds into frame {}'.format(
                 note_length, start))
             song = song.insert(
-                start, sig_gen.sin_constant(note.pitch.frequency,
-                                            length=note_length))
+                start, sig_gen.sin_constant(frequency, length=note_length))
     except KeyboardInterrupt:
         print('Stopping song generating here...')
 
     return song
 
-def audify_to_file(score, tempo, filename, verbose=False):
-    sig_gen = Generator(verbose)
-    song = Waveform([])
+
+def note_events(score, tempo):
+    """Collect every pitch of every note and chord in a score.
+
+    The score may also be a note array from potty_oh.score_cache.
+
+    Returns the tuple: (onsets, durations, frequencies) as arrays in seconds
+    """
     qnl = quarter_note_length(tempo)
+    if isinstance(score, numpy.ndarray):
+        return (qnl * score['onset'], qnl * score['duration'],
+                numpy.array(score['frequency'], dtype=float))
+    events = [(qnl * float(note.offset), qnl * float(note.quarterLength),
+               pitch.frequency)
+              for note in score.flat.notes for pitch in note.pitches]
+    if not events:
+        return numpy.zeros(0), numpy.zeros(0), numpy.zeros(0)
+    return tuple(numpy.array(column, dtype=float)
+                 for column in zip(*events))
+
+
+def max_polyphony(starts, stops):
+    """The largest number of notes sounding at once.
+
+    Notes ending on the same frame another starts don't overlap.
+    """
+    if not len(starts):
+        return 0
+    bounds = numpy.concatenate([starts, stops])
+    changes = numpy.concatenate([numpy.ones(len(starts), dtype=int),
+                                 -numpy.ones(len(stops), dtype=int)])
+    order = numpy.lexsort((changes, bounds))
+    return int(numpy.cumsum(changes[order]).max())
+
+
+def _note_frames(onsets, durations, framerate):
+    """The start and stop frames of notes, as rendered by a Generator."""
+    starts = numpy.floor(onsets * framerate).astype(int)
+    stops = starts + (durations * framerate).astype(int)
+    return starts, stops
+
+
+def render_events(onsets, durations, frequencies, framerate=None,
+                  verbose=False):
+    """Render notes given in seconds into a single preallocated Waveform.
+
+    Each note is generated once and added into its slice of the song so
+    overlapping notes (chords and multiple parts) are mixed. The mix is
+    scaled by the largest number of simultaneous notes so it can't clip.
+    """
+    if not framerate:
+        framerate = defaults.framerate
+    sig_gen = Generator(framerate=framerate, verbose=verbose)
+    starts, stops = _note_frames(onsets, durations, framerate)
+    song = numpy.zeros(stops.max() if len(stops) else 0)
+    for count, (start, stop, duration, frequency) in enumerate(
+            zip(starts, stops, durations, frequencies)):
+        if stop <= start:
+            continue
+        sig_gen.dprint('{}/{}: {} Hz for {} seconds at frame {}'.format(
+            count, len(starts), frequency, duration, start))
+        song[start:stop] += sig_gen.sin_constant(
+            frequency, length=duration).frames
+    polyphony = max_polyphony(starts, stops)
+    if polyphony > 1:
+        song /= polyphony
+    return Waveform(song, framerate, copy=False)
+
+
+def audify_offline(score, tempo, verbose=False):
+    """Audify a music21 score or note array in one pass honouring offsets.
+
+    Unlike audify_basic, which reallocates and mixes the whole song for
+    every note, the song is allocated once and each note is added in place.
+    """
+    return render_events(*note_events(score, tempo), verbose=verbose)
+
+
+def stream_events(onsets, durations, frequencies, writer, block_size=None,
+                  framerate=None, verbose=False):
+    """Render notes given in seconds to a writer with bounded memory.
+
+    Notes are rendered in onset order into a ring buffer holding one block
+    plus the longest note. Once no later note can start inside a block the
+    block is mixed, written and cleared, so memory use depends on the
+    longest note rather than the length of the song. Overlapping notes are
+    scaled by the largest number of simultaneous notes like render_events.
+
+    Returns the number of frames written.
+    """
+    if not framerate:
+        framerate = defaults.framerate
+    if not block_size:
+        block_size = defaults.block_size
+    sig_gen = Generator(framerate=framerate, verbose=verbose)
+    starts, stops = _note_frames(onsets, durations, framerate)
+    if not len(starts):
+        return 0
+    order = numpy.argsort(starts, kind='stable')
+    polyphony = max_polyphony(starts, stops)
+    gain = 1.0 / polyphony if polyphony > 1 else 1.0
+    ring = numpy.zeros(block_size + int((stops - starts).max()))
+    flushed = 0  # the first frame that hasn't been written yet
+
+    def flush(count):
+        indices = (flushed + numpy.arange(count)) % len(ring)
+        writer.write_frames(ring[indices] * gain)
+        ring[indices] = 0.0
+        return flushed + count
+
+    for count, index in enumerate(order):
+        start, stop = starts[index], stops[index]
+        while start >= flushed + block_size:
+            flushed = flush(block_size)
+        if stop <= start:
+            continue
+        sig_gen.dprint('{}/{}: {} Hz for {} seconds at frame {}'.format(
+            count, len(order), frequencies[index], durations[index], start))
+        ring[numpy.arange(start, stop) % len(ring)] += sig_gen.sin_constant(
+            frequencies[index], length=durations[index]).frames
+    end = stops.max()
+    while flushed < end:
+        flushed = flush(min(block_size, end - flushed))
+    return flushed
+
+
+def audify_to_file(score, tempo, filename, verbose=False, **kwargs):
+    """Audify a music21 score or note array straight to a file.
+
+    Note offsets are honoured so chords and parts are mixed together.
+
+    Keyword arguments are passed to the ThreadedWriter.
+    """
+    with ThreadedWriter(filename, **kwargs) as fout:
+        return stream_events(*note_events(score, tempo), writer=fout,
+                             verbose=verbose)
 
-    notes = score.flat.notes
-    note_count = len(notes)
-    with wav_file_context(filename) as fout:
-        for count, note in enumerate(notes):
-            print('{}/{}: {} [{}]: {} {}'.format(
-                count, note_count, note.offset, note.duration.quarterLength,
-                note.pitch, note.pitch.frequency))
-            note_length = qnl * note.quarterLength
-            fout.write_frames(sig_gen.sin_constant(
-                note.pitch.frequency, length=note_length).frames)
 
 def audify(score, tempo, verbose=False):
     sig_gen = PhasorGenerator()
     qnl = quarter_note_length(tempo)
 
-    notes = score.flat.notes
+    notes = _score_notes(score)
     note_count = len(notes)
-    for count, note in enumerate(notes):
+    for count, (offset, length, pitch, frequency) in enumerate(notes):
         if verbose:
             print('{}/{}: at time {} for {} at "{}": {}'.format(
-                  count, note_count, note.offset, note.duration.quarterLength,
-                  note.pitch, note.pitch.frequency))
-        note_length = qnl * note.quarterLength
-        sig_gen.generate(note.pitch.frequency, note_length)
+                  count, note_count, offset, length, pitch, frequency))
+        note_length = qnl * length
+        sig_gen.generate(frequency, note_length)
     return sig_gen.waveform
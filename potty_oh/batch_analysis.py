@@ -0,0 +1,186 @@
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""batch_analysis.py: analyze many audio files in parallel.
+
+Results for each file are written to a compressed ``.npz`` file in a store
+directory alongside an ``index.json`` that maps each analyzed file to its
+results. Files whose size, modification time and analysis parameters match
+the index are skipped when the analysis is run again.
+"""
+
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+from pysndfile import PySndfile
+
+from .common import vprint
+from .waveform import Waveform
+from .wav_file import WavReader
+from .analysis import stft, spectral_peaks, track_pitch
+
+INDEX_NAME = 'index.json'
+
+DEFAULT_PARAMETERS = {
+    'window_size': None,
+    'hop_size': None,
+    'peak_count': 5,
+    'min_frequency': 50.0,
+    'max_frequency': 2000.0,
+}
+
+
+def analysis_parameters(**kwargs):
+    """Fill in the default analysis parameters for any not given."""
+    unknown = set(kwargs) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise TypeError('Unknown analysis parameters: %s' %
+                        ', '.join(sorted(unknown)))
+    params = DEFAULT_PARAMETERS.copy()
+    params.update(kwargs)
+    return params
+
+
+def _load(path):
+    """Read a whole audio file into a Waveform."""
+    if path.lower().endswith('.wav'):
+        return WavReader(path).waveform(normalize=True)
+    sndfile = PySndfile(path, 'r')
+    return Waveform(sndfile.read_frames(), sndfile.samplerate())
+
+
+def _fingerprint(path):
+    """The (size, mtime) pair used to detect changed input files."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def store_name(path):
+    """The name of the results file in the store for an input file."""
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    base = os.path.splitext(os.path.basename(path))[0]
+    return '{}-{}.npz'.format(base, digest[:12])
+
+
+def analyze_file(path, store_path, params):
+    """Analyze a single audio file and save the features to store_path.
+
+    Returns the number of seconds the analysis took.
+    """
+    start = time.time()
+    waveform = _load(path)
+    times, frequencies, spectrum = stft(
+        waveform, params['window_size'], params['hop_size'])
+    magnitudes = numpy.abs(spectrum).astype(numpy.float32)
+    peaks = spectral_peaks(magnitudes, frequencies, params['peak_count'])
+    pitch_times, pitch, confidence = track_pitch(
+        waveform, params['min_frequency'], params['max_frequency'])
+    numpy.savez_compressed(
+        store_path, framerate=waveform.framerate, length=waveform.length,
+        times=times, frequencies=frequencies, magnitudes=magnitudes,
+        peaks=peaks, pitch_times=pitch_times, pitch=pitch,
+        confidence=confidence)
+    return time.time() - start
+
+
+def load_index(store_dir):
+    """Load the index of a results store, empty if it doesn't exist yet."""
+    index_path = os.path.join(store_dir, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as fin:
+        return json.load(fin)
+
+
+def save_index(store_dir, index):
+    """Atomically replace the index of a results store."""
+    index_path = os.path.join(store_dir, INDEX_NAME)
+    with open(index_path + '.tmp', 'w') as fout:
+        json.dump(index, fout, indent=2, sort_keys=True)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def load_results(store_dir, path):
+    """Load the stored analysis results for an input file."""
+    entry = load_index(store_dir)[os.path.abspath(path)]
+    if 'error' in entry:
+        raise ValueError('Analysis of %s failed: %s' % (path, entry['error']))
+    return numpy.load(os.path.join(store_dir, entry['store']))
+
+
+def is_current(store_dir, entry, path, params):
+    """Whether an index entry is up to date for the file and parameters.
+
+    Files that failed to analyze are never up to date so they are retried.
+    """
+    if not entry or 'error' in entry:
+        return False
+    size, mtime = _fingerprint(path)
+    return (entry['size'] == size and entry['mtime'] == mtime and
+            entry['params'] == params and
+            os.path.exists(os.path.join(store_dir, entry['store'])))
+
+
+def analyze_files(paths, store_dir, workers=None, force=False, **kwargs):
+    """Analyze audio files on a process pool and record them in a store.
+
+    Unchanged files that were already analyzed with the same parameters are
+    skipped unless force is set. The index is saved after each file so an
+    interrupted run can be resumed. A file that can't be analyzed doesn't
+    stop the others: its index entry records the error instead of a store.
+    Keyword arguments override the analysis parameters.
+
+    Returns the updated index.
+    """
+    params = analysis_parameters(**kwargs)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    index = load_index(store_dir)
+    pending = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if not force and is_current(store_dir, index.get(path), path,
+                                    params):
+            vprint('skipping unchanged file {}'.format(path))
+            continue
+        pending.append(path)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for path in pending:
+            name = store_name(path)
+            future = pool.submit(analyze_file, path,
+                                 os.path.join(store_dir, name), params)
+            futures[future] = (path, name, _fingerprint(path))
+        for count, future in enumerate(as_completed(futures), 1):
+            path, name, (size, mtime) = futures[future]
+            try:
+                elapsed = future.result()
+            except Exception as exc:
+                index[path] = {'error': str(exc), 'size': size,
+                               'mtime': mtime, 'params': params}
+                save_index(store_dir, index)
+                print('{}/{}: failed to analyze {}: {}'.format(
+                    count, len(pending), path, exc))
+                continue
+            index[path] = {'store': name, 'size': size, 'mtime': mtime,
+                           'params': params, 'seconds': elapsed}
+            save_index(store_dir, index)
+            vprint('{}/{}: analyzed {} in {:.2f} seconds'.format(
+                count, len(pending), path, elapsed))
+    return index
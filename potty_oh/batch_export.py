@@ -0,0 +1,255 @@
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""batch_export.py: render many works and write them to a directory.
+
+Renders run on a process pool so every core is used while the finished
+waveforms are handed to a small thread pool that writes them to disk. A
+``manifest.json`` in the output directory lists each file written along with
+its duration, how long it took to render and write, and the parameters it
+was rendered with. Files already rendered with matching parameters are
+skipped when the export is run again so an interrupted export can be resumed.
+"""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+from collections import namedtuple, Counter
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
+import numpy
+
+from .common import defaults, vprint
+from .audify import audify_offline
+from .score_cache import load_score
+from .wav_file import ThreadedWriter
+
+MANIFEST_NAME = 'manifest.json'
+
+ExportJob = namedtuple('ExportJob', 'filename render args kwargs')
+ExportJob.__doc__ = """A render to export.
+
+The render must be a module level function (so it can be sent to a worker
+process) that is called with the args and kwargs and returns a Waveform.
+"""
+
+
+def render_score(path, tempo=None, seed=None):
+    """Audify a score file or music21 corpus path using the score cache.
+
+    The seed sets the state of the random generator used for note phases.
+    """
+    if not tempo:
+        tempo = defaults.tempo
+    if seed is not None:
+        numpy.random.seed(seed)
+    return audify_offline(load_score(path), tempo)
+
+
+def output_name(path):
+    """A unique wav filename for a score file or music21 corpus work.
+
+    The name starts with the score's directory and file name and ends with
+    a short hash of the whole path (or corpus name), so scores whose names
+    only differ in a suffix like bach/bwv65.2 and bach/bwv65.3 don't share
+    a file.
+    """
+    if os.path.exists(path):
+        path = os.path.abspath(path)
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    directory, base = os.path.split(path)
+    base = os.path.splitext(base)[0]
+    return '{}-{}-{}.wav'.format(os.path.basename(directory), base,
+                                 digest[:12])
+
+
+def work_seed(seed, name):
+    """A seed for one work derived from a base seed and the work's name."""
+    return zlib.crc32('{}:{}'.format(seed, name).encode('utf-8')) & 0xFFFFFFFF
+
+
+def score_jobs(paths, tempo=None, seed=None):
+    """Create an ExportJob to audify each score path.
+
+    Given a seed each work is rendered with its own seed derived from it,
+    so renders are repeatable no matter which worker process runs them.
+    A score given more than once only gets one job.
+    """
+    jobs = []
+    names = set()
+    for path in paths:
+        name = output_name(path)
+        if name in names:
+            continue
+        names.add(name)
+        kwargs = {'tempo': tempo, 'seed': None}
+        if seed is not None:
+            kwargs['seed'] = work_seed(seed, name)
+        jobs.append(ExportJob(name, render_score, (path,), kwargs))
+    return jobs
+
+
+def _render(job, framerate):
+    """Run a job's render in a worker process.
+
+    Returns the tuple: (frames, framerate, seconds)
+    """
+    defaults.framerate = framerate
+    start = time.time()
+    waveform = job.render(*job.args, **job.kwargs)
+    return waveform.frames, waveform.framerate, time.time() - start
+
+
+def _write(path, frames, framerate, **kwargs):
+    """Write rendered frames to a file and return the seconds it took."""
+    start = time.time()
+    with ThreadedWriter(path, framerate=framerate, **kwargs) as fout:
+        fout.write_frames(frames)
+    return time.time() - start
+
+
+def load_manifest(directory):
+    """Load the manifest of an output directory, empty if there isn't one."""
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path) as fin:
+        return json.load(fin)
+
+
+def save_manifest(directory, manifest):
+    """Atomically replace the manifest of an output directory."""
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as fout:
+        json.dump(manifest, fout, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def job_parameters(job, **kwargs):
+    """The parameters a job is rendered and written with, as stored in JSON.
+
+    Keyword arguments are the ThreadedWriter arguments.
+    """
+    return json.loads(json.dumps({
+        'render': job.render.__name__, 'args': job.args,
+        'kwargs': job.kwargs, 'framerate': defaults.framerate,
+        'writer': kwargs}))
+
+
+def is_current(directory, entry, params):
+    """Whether a manifest entry was written with the same parameters.
+
+    Jobs that failed are never current so they are tried again.
+    """
+    if not entry or 'error' in entry:
+        return False
+    return entry.get('params') == params and os.path.exists(
+        os.path.join(directory, entry['filename']))
+
+
+def export_batch(jobs, directory, workers=None, writers=2, force=False,
+                 **kwargs):
+    """Render jobs on a process pool and write them to a directory.
+
+    Finished renders are written by a pool of writer threads so rendering
+    carries on while files are written. Keyword arguments are passed to the
+    ThreadedWriter for each file (e.g. encoding). Jobs whose file was
+    already exported with the same parameters are skipped unless force is
+    set. The manifest is saved as each file is written. A job that fails to
+    render or write doesn't stop the others, its manifest entry has an
+    error message instead of the render details.
+
+    Raises ValueError if two jobs would write the same file.
+
+    Returns the manifest: a list of dicts describing each file exported.
+    """
+    jobs = list(jobs)
+    counts = Counter(job.filename for job in jobs)
+    duplicates = sorted(name for name, count in counts.items() if count > 1)
+    if duplicates:
+        raise ValueError('Jobs would overwrite each other: {}'.format(
+            ', '.join(duplicates)))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = dict((entry['filename'], entry)
+                    for entry in load_manifest(directory))
+    pending = []
+    for job in jobs:
+        params = job_parameters(job, **kwargs)
+        if not force and is_current(directory, manifest.get(job.filename),
+                                    params):
+            vprint('skipping already exported {}'.format(job.filename))
+            continue
+        pending.append((job, params))
+
+    progress = {'count': 0}
+
+    def record(entry):
+        progress['count'] += 1
+        manifest[entry['filename']] = entry
+        save_manifest(directory, sorted(
+            manifest.values(), key=lambda entry: entry['filename']))
+        if 'error' in entry:
+            print('{}/{}: failed to export {}: {}'.format(
+                progress['count'], len(pending), entry['filename'],
+                entry['error']))
+            return
+        vprint('{}/{}: exported {} ({:.1f} seconds of audio) rendered '
+               'in {:.2f} seconds ({:.1f}x realtime) and written in {:.2f} '
+               'seconds'.format(
+                   progress['count'], len(pending), entry['filename'],
+                   entry['duration'], entry['render_seconds'],
+                   entry['realtime_factor'], entry['write_seconds']))
+
+    def finish(future):
+        entry = writes.pop(future)
+        try:
+            entry['write_seconds'] = future.result()
+        except Exception as exc:
+            entry['error'] = str(exc)
+        record(entry)
+
+    writes = {}
+    # reseed each worker from the OS so forked workers don't share the
+    # random state of this process, jobs with a seed set their own
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=numpy.random.seed) as render_pool, \
+            ThreadPoolExecutor(max_workers=writers) as write_pool:
+        renders = dict((render_pool.submit(_render, job, defaults.framerate),
+                        (job, params)) for job, params in pending)
+        for future in as_completed(renders):
+            job, params = renders[future]
+            try:
+                frames, framerate, render_seconds = future.result()
+            except Exception as exc:
+                record({'filename': job.filename, 'params': params,
+                        'error': str(exc)})
+                continue
+            path = os.path.join(directory, job.filename)
+            duration = float(len(frames)) / framerate
+            entry = {'filename': job.filename, 'frames': len(frames),
+                     'framerate': framerate, 'duration': duration,
+                     'render_seconds': render_seconds,
+                     'realtime_factor': duration / max(render_seconds, 1e-9),
+                     'params': params}
+            writes[write_pool.submit(_write, path, frames, framerate,
+                                     **kwargs)] = entry
+            for done in [write for write in writes if write.done()]:
+                finish(done)
+        for done in as_completed(list(writes)):
+            finish(done)
+    return sorted(manifest.values(), key=lambda entry: entry['filename'])
@@ -22,6 +22,7 @@ class _Defaults:
     tempo = 100
     framerate = 44100
     channels = 1
+    block_size = 4096
     frequency = 440.0
     length = 1.0
     filename = 'signal.wav'
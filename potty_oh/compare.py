@@ -0,0 +1,195 @@
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""compare.py: measure the differences between two renders.
+
+Both signals are read one block at a time so files of any length can be
+compared in bounded memory.
+"""
+
+try:
+    from itertools import zip_longest
+except ImportError:  # python 2...  bleh!
+    from itertools import izip_longest as zip_longest
+
+import numpy
+from pysndfile import PySndfile
+
+from .common import defaults
+from .waveform import Waveform
+from .wav_file import WavReader
+
+
+def iter_blocks(source, block_size=None):
+    """Read a Waveform, array or audio file one block at a time.
+
+    Returns the tuple: (framerate, blocks)
+    """
+    if not block_size:
+        block_size = defaults.block_size
+    if isinstance(source, Waveform):
+        return source.framerate, _array_blocks(source.frames, block_size)
+    if isinstance(source, numpy.ndarray):
+        return defaults.framerate, _array_blocks(source, block_size)
+    if source.lower().endswith('.wav'):
+        reader = WavReader(source)
+        return reader.framerate, reader.blocks(block_size)
+    sndfile = PySndfile(source, 'r')
+    return sndfile.samplerate(), _file_blocks(sndfile, block_size)
+
+
+def _array_blocks(wavedata, block_size):
+    for start in range(0, len(wavedata), block_size):
+        yield wavedata[start:start + block_size]
+
+
+def _file_blocks(sndfile, block_size):
+    remaining = sndfile.frames()
+    while remaining > 0:
+        block = sndfile.read_frames(min(block_size, remaining))
+        if not len(block):
+            break
+        remaining -= len(block)
+        yield block
+
+
+def octave_bands(framerate, lowest=62.5):
+    """Band edges in Hz: below lowest, then octaves up to Nyquist."""
+    edges = [0.0]
+    edge = lowest
+    while edge < framerate / 2.0:
+        edges.append(edge)
+        edge *= 2
+    edges.append(framerate / 2.0)
+    return numpy.array(edges)
+
+
+class DiffReport(object):
+    """The differences found between a first and second signal."""
+    def __init__(self, framerate, tolerance):
+        self.framerate = framerate
+        self.tolerance = tolerance
+        self.frames = 0
+        self.first_length = 0
+        self.second_length = 0
+        self.max_error = 0.0
+        self.first_divergent_frame = None
+        self.signal_energy = 0.0
+        self.error_energy = 0.0
+        self.bands = octave_bands(framerate)
+        self._band_error = numpy.zeros(len(self.bands) - 1)
+        self._band_blocks = 0
+
+    @property
+    def identical(self):
+        """Whether the signals match in length and within the tolerance."""
+        return (self.first_length == self.second_length and
+                self.max_error <= self.tolerance)
+
+    @property
+    def snr(self):
+        """Signal to noise ratio in dB treating the first as the signal."""
+        if self.error_energy == 0:
+            return numpy.inf
+        with numpy.errstate(divide='ignore'):
+            return 10 * numpy.log10(self.signal_energy / self.error_energy)
+
+    @property
+    def band_distance(self):
+        """RMS difference in dB of the block spectra in each octave band."""
+        if not self._band_blocks:
+            return numpy.zeros(len(self._band_error))
+        return numpy.sqrt(self._band_error / self._band_blocks)
+
+    def update(self, first, second):
+        """Compare the next pair of blocks, padding the shorter one."""
+        first = numpy.zeros(0) if first is None else numpy.asarray(first)
+        second = numpy.zeros(0) if second is None else numpy.asarray(second)
+        self.first_length += len(first)
+        self.second_length += len(second)
+        length = max(len(first), len(second))
+        shape = (length,) + (first.shape[1:] or second.shape[1:])
+        padded = numpy.zeros((2,) + shape)
+        padded[0, :len(first)] = first
+        padded[1, :len(second)] = second
+
+        difference = padded[0] - padded[1]
+        error = numpy.abs(difference)
+        if error.ndim > 1:
+            error = error.max(axis=1)
+        if length:
+            self.max_error = max(self.max_error, float(error.max()))
+        if self.first_divergent_frame is None:
+            divergent = numpy.flatnonzero(error > self.tolerance)
+            if len(divergent):
+                self.first_divergent_frame = self.frames + int(divergent[0])
+        self.signal_energy += float(numpy.sum(numpy.square(padded[0])))
+        self.error_energy += float(numpy.sum(numpy.square(difference)))
+        self._update_bands(padded)
+        self.frames += length
+
+    def _update_bands(self, padded):
+        """Accumulate the per band spectral differences of a block pair."""
+        if padded.ndim > 2:
+            padded = padded.mean(axis=2)
+        if padded.shape[1] < 2:
+            return
+        power = numpy.square(numpy.abs(numpy.fft.rfft(padded, axis=1)))
+        frequencies = numpy.fft.rfftfreq(padded.shape[1],
+                                         1.0 / self.framerate)
+        band = numpy.digitize(frequencies, self.bands[1:-1])
+        energy = numpy.zeros((2, len(self._band_error)))
+        for index in range(2):
+            energy[index] = numpy.bincount(band, weights=power[index],
+                                           minlength=len(self._band_error))
+        # a small floor keeps silent bands from dominating the distance
+        floor = 1e-10 * max(energy.max(), 1e-30)
+        decibels = 10 * numpy.log10(energy + floor)
+        self._band_error += numpy.square(decibels[0] - decibels[1])
+        self._band_blocks += 1
+
+    def __str__(self):
+        lines = [
+            'frames compared: {} ({} vs {})'.format(
+                self.frames, self.first_length, self.second_length),
+            'identical within {}: {}'.format(self.tolerance,
+                                             self.identical),
+            'max absolute error: {}'.format(self.max_error),
+            'SNR: {:.2f} dB'.format(self.snr),
+            'first divergent frame: {}'.format(self.first_divergent_frame),
+            'spectral distance per band (dB):']
+        for low, high, distance in zip(self.bands[:-1], self.bands[1:],
+                                       self.band_distance):
+            lines.append('  {:>8.1f} - {:>8.1f} Hz: {:.3f}'.format(
+                low, high, distance))
+        return '\n'.join(lines)
+
+
+def compare(first, second, block_size=None, tolerance=0.0):
+    """Compare two Waveforms, arrays or audio files block by block.
+
+    Frames that differ by more than tolerance are considered divergent.
+
+    Returns a DiffReport.
+    """
+    framerate, first_blocks = iter_blocks(first, block_size)
+    second_framerate, second_blocks = iter_blocks(second, block_size)
+    if framerate != second_framerate:
+        raise ValueError('Cannot compare signals with framerates of {} and '
+                         '{}.'.format(framerate, second_framerate))
+    report = DiffReport(framerate, tolerance)
+    for first_block, second_block in zip_longest(first_blocks,
+                                                 second_blocks):
+        report.update(first_block, second_block)
+    return report
@@ -14,6 +14,10 @@
 
 """effects.py: a library of effects to apply to waveforms."""
 
+import math
+import numpy
+
+from .common import defaults
 from .waveform import Waveform
 
 
@@ -25,3 +29,189 @@ def normalize(waveform):
     peak = max(wavedata)
     wavedata *= 1.0 / peak
     return wavedata
+
+
+def apply_effect(effect, waveform, block_size=None, tail=0.0):
+    """Run a whole waveform through a streaming effect one block at a time.
+
+    The optional tail is a number of seconds of silence to feed through the
+    effect after the waveform so that echoes are not cut off.
+    """
+    if not block_size:
+        block_size = defaults.block_size
+    framerate = defaults.framerate
+    wavedata = waveform
+    if isinstance(waveform, Waveform):
+        framerate = waveform.framerate
+        wavedata = waveform.frames
+    wavedata = numpy.asarray(wavedata, dtype=float)
+    output = numpy.zeros((len(wavedata) + int(tail * framerate),) +
+                         wavedata.shape[1:])
+    for start in range(0, len(output), block_size):
+        block = output[start:start + block_size]
+        source = wavedata[start:start + block_size]
+        block[:len(source)] = source
+        block[:] = effect.process(block)
+    return Waveform(output, framerate)
+
+
+class DelayLine(object):
+    """A fixed size circular buffer holding the most recent frames of a signal.
+
+    Only enough history for the longest delay is kept so memory use does not
+    grow with the length of the signal. Reads may use fractional delays which
+    are resolved with linear interpolation between neighbouring frames.
+    """
+    def __init__(self, max_delay, channels=1):
+        if max_delay < 1:
+            raise ValueError('A DelayLine needs a delay of at least 1 frame.')
+        self.max_delay = float(max_delay)
+        self.size = int(math.ceil(max_delay)) + 1
+        shape = (self.size,) if channels == 1 else (self.size, channels)
+        self.buffer = numpy.zeros(shape)
+        self.position = 0  # index where the next frame will be written
+
+    def read(self, delays):
+        """Read delayed frames for each frame of the next block to be written.
+
+        ``delays[i]`` is the delay in frames of the i'th frame of the upcoming
+        block. Every delay must be at least ``len(delays)`` so that all of the
+        requested frames have already been written.
+        """
+        delays = numpy.asarray(delays, dtype=float)
+        positions = self.position + numpy.arange(len(delays)) - delays
+        base = numpy.floor(positions)
+        fraction = positions - base
+        first = base.astype(int) % self.size
+        second = (first + 1) % self.size
+        if self.buffer.ndim > 1:
+            fraction = fraction[:, numpy.newaxis]
+        return (self.buffer[first] * (1.0 - fraction) +
+                self.buffer[second] * fraction)
+
+    def write(self, block):
+        """Append a block of frames, overwriting the oldest history."""
+        indices = (self.position + numpy.arange(len(block))) % self.size
+        self.buffer[indices] = block
+        self.position = (self.position + len(block)) % self.size
+
+
+class Delay(object):
+    """Mix a signal with a copy of itself delayed by a constant time.
+
+    Delays are given in seconds. Feedback sends the delayed signal back into
+    the delay line to produce repeating echoes. Blocks of any size can be
+    passed to ``process`` and the effect state carries over between calls so
+    the effect can run in a streaming pipeline.
+    """
+    def __init__(self, delay=0.25, feedback=0.0, mix=0.5, framerate=None):
+        self.framerate = framerate
+        if not framerate:
+            self.framerate = defaults.framerate
+        self.delay = delay
+        self.feedback = feedback
+        self.mix = mix
+        self.line = None
+        self.elapsed = 0  # frames processed so far
+
+    @property
+    def max_delay(self):
+        """The longest delay used by the effect in frames."""
+        return self.delay * self.framerate
+
+    @property
+    def min_delay(self):
+        """The shortest delay used by the effect in frames."""
+        return self.delay * self.framerate
+
+    def _delays(self, count):
+        """The delay in frames for each of the next count frames."""
+        return numpy.full(count, self.delay * self.framerate)
+
+    def reset(self):
+        """Forget the signal history."""
+        self.line = None
+        self.elapsed = 0
+
+    def _read(self, count):
+        """Read the delayed signal for the next count frames."""
+        return self.line.read(self._delays(count))
+
+    def process(self, block):
+        """Apply the effect to the next block of the signal."""
+        block = numpy.asarray(block, dtype=float)
+        if self.line is None:
+            channels = 1 if block.ndim == 1 else block.shape[1]
+            self.line = DelayLine(self.max_delay, channels)
+        # Each chunk is no longer than the shortest delay so every delayed
+        # frame has already been written (including feedback) when it's read.
+        chunk_size = int(math.floor(self.min_delay))
+        if chunk_size < 1:
+            raise ValueError('Delays must be at least 1 frame long.')
+        output = numpy.empty_like(block)
+        for start in range(0, len(block), chunk_size):
+            chunk = block[start:start + chunk_size]
+            delayed = self._read(len(chunk))
+            self.line.write(chunk + self.feedback * delayed)
+            output[start:start + len(chunk)] = (
+                (1.0 - self.mix) * chunk + self.mix * delayed)
+            self.elapsed += len(chunk)
+        return output
+
+
+class Echo(Delay):
+    """A delay with feedback so each echo repeats and decays."""
+    def __init__(self, delay=0.3, feedback=0.5, mix=0.5, framerate=None):
+        super(Echo, self).__init__(delay, feedback, mix, framerate)
+
+
+class ModulatedDelay(Delay):
+    """A delay whose time is swept by a low frequency sine oscillator.
+
+    Multiple voices use evenly spaced oscillator phases and are averaged.
+    """
+    def __init__(self, delay, depth, rate, feedback=0.0, mix=0.5, voices=1,
+                 framerate=None):
+        super(ModulatedDelay, self).__init__(delay, feedback, mix, framerate)
+        if depth >= delay:
+            raise ValueError('Modulation depth must be less than the delay.')
+        self.depth = depth
+        self.rate = rate
+        self.voices = voices
+
+    @property
+    def max_delay(self):
+        return (self.delay + self.depth) * self.framerate
+
+    @property
+    def min_delay(self):
+        return (self.delay - self.depth) * self.framerate
+
+    def _delays(self, count):
+        """The delay in frames per voice (rows) for the next count frames."""
+        time = (self.elapsed + numpy.arange(count)) / float(self.framerate)
+        phases = 2 * math.pi * numpy.arange(self.voices) / self.voices
+        angles = (2 * math.pi * self.rate * time[numpy.newaxis, :] +
+                  phases[:, numpy.newaxis])
+        return (self.delay + self.depth * numpy.sin(angles)) * self.framerate
+
+    def _read(self, count):
+        """Average the delayed signal read by each voice."""
+        voices = [self.line.read(delays) for delays in self._delays(count)]
+        return sum(voices) / float(self.voices)
+
+
+class Chorus(ModulatedDelay):
+    """Thicken a signal with slowly detuned copies of itself."""
+    def __init__(self, delay=0.025, depth=0.005, rate=0.8, feedback=0.0,
+                 mix=0.5, voices=3, framerate=None):
+        super(Chorus, self).__init__(delay, depth, rate, feedback, mix,
+                                     voices, framerate)
+
+
+class Flanger(ModulatedDelay):
+    """A short swept delay with feedback for a comb filtered "whoosh"."""
+    def __init__(self, delay=0.003, depth=0.002, rate=0.25, feedback=0.5,
+                 mix=0.5, voices=1, framerate=None):
+        super(Flanger, self).__init__(delay, depth, rate, feedback, mix,
+                                      voices, framerate)
@@ -0,0 +1,103 @@
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""score_cache.py: parse music21 scores once into compact note arrays.
+
+Parsing a score and walking its music21 objects often takes longer than
+synthesizing it. The notes of a score are converted to a NumPy structured
+array with the NOTE_DTYPE fields (onset and duration in quarter notes so the
+array doesn't depend on the tempo) and cached on disk. The cache is keyed by
+the score's path and modification time, or by the name of a music21 corpus
+work, so repeat renders skip music21 entirely: music21 is only imported
+when a score has to be parsed. The audify renderers accept these arrays in
+place of a score.
+"""
+
+import os
+import hashlib
+
+import numpy
+
+NOTE_DTYPE = numpy.dtype([
+    ('onset', numpy.float64),
+    ('duration', numpy.float64),
+    ('frequency', numpy.float64),
+    ('part', numpy.int16),
+    ('velocity', numpy.uint8),
+])
+
+DEFAULT_VELOCITY = 64
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'potty_oh', 'scores')
+
+
+def score_notes(score):
+    """Convert every pitch of every note and chord in a score to an array.
+
+    Each part of the score is numbered in order. Notes are sorted by onset.
+    """
+    parts = list(getattr(score, 'parts', None) or [score])
+    notes = []
+    for part_number, part in enumerate(parts):
+        for note in part.flat.notes:
+            velocity = note.volume.velocity
+            if velocity is None:
+                velocity = DEFAULT_VELOCITY
+            for pitch in note.pitches:
+                notes.append((float(note.offset), float(note.quarterLength),
+                              pitch.frequency, part_number, velocity))
+    notes = numpy.array(notes, dtype=NOTE_DTYPE)
+    return notes[numpy.argsort(notes['onset'], kind='stable')]
+
+
+def cache_name(path):
+    """The name of the cache file for a score file or corpus work."""
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    base = os.path.splitext(os.path.basename(path))[0]
+    return '{}-{}.npz'.format(base, digest[:12])
+
+
+def _parse(path):
+    """Parse a score file or music21 corpus work with music21."""
+    from music21 import corpus  # only imported when there's no cache
+    return corpus.parse(path)
+
+
+def load_score(path, cache_dir=None):
+    """Load the note array of a score, parsing it only if not cached.
+
+    The path may be a score file or a music21 corpus work. A cached score
+    file is used when its modification time matches the cached one. Corpus
+    works are cached by name since the corpus doesn't change.
+    """
+    if not cache_dir:
+        cache_dir = DEFAULT_CACHE_DIR
+    mtime = 0.0
+    if os.path.exists(path):
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime
+    cache_path = os.path.join(cache_dir, cache_name(path))
+    if os.path.exists(cache_path):
+        with numpy.load(cache_path) as cached:
+            if cached['path'] == path and cached['mtime'] == mtime:
+                return cached['notes']
+
+    notes = score_notes(_parse(path))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cache_path + '.tmp', 'wb') as fout:
+        numpy.savez(fout, notes=notes, path=path, mtime=mtime)
+    os.replace(cache_path + '.tmp', cache_path)
+    return notes
@@ -89,17 +89,15 @@ class Generator(object):
         frequency = float(frequency)
         fade_frames = self.fade_percentage * self.framecount
         fade_point = self.framecount - fade_frames
-        for frame in range(self.framecount):
-            value = self._sinusoid_value(frame, frequency)
-            if frame > fade_point:  # fade the end of the note
-                _old = value
-                value *= 1 - (frame - fade_point) / fade_frames
-                if frame % 50 == 0:
-                    self.dprint('fade from %s to %s' % (_old, value))
-            if frame < fade_frames:
-                _old = value
-                value *= frame / fade_frames
-            self.wavedata[frame] = value
+        frames = numpy.arange(self.framecount)
+        self.wavedata = numpy.sin(
+            self.phase + self._sinusoid_angle(frames, frequency))
+        fade_out = frames > fade_point  # fade the end of the note
+        self.wavedata[fade_out] *= (
+            1 - (frames[fade_out] - fade_point) / fade_frames)
+        fade_in = frames < fade_frames
+        self.wavedata[fade_in] *= frames[fade_in] / fade_frames
+        self.dprint('faded %s frames in and out' % fade_frames)
         return self.waveform
 
     def sin_linear(self, start_freq, end_freq, *args, **kwargs):
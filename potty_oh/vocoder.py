@@ -0,0 +1,90 @@
+# Copyright 2016 Curtis Sand
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+"""vocoder.py: phase vocoder time stretching and pitch shifting.
+
+A phase vocoder resamples the frames of a Short Time Fourier Transform in
+time. Magnitudes are interpolated between neighbouring frames and the phase
+of every bin is advanced by the frequency measured between those frames so
+the sinusoids stay continuous across the new frame spacing. The phase
+advances for all bins and frames are calculated together and accumulated
+with a single cumulative sum. Stereo waveforms are mixed down to mono.
+"""
+
+import numpy
+from scipy.signal import resample
+
+from .waveform import Waveform
+from .analysis import _mono_wavedata, stft, istft
+
+
+def _wrap(phase):
+    """Wrap phase angles into the range -pi to pi."""
+    return phase - 2 * numpy.pi * numpy.round(phase / (2 * numpy.pi))
+
+
+def time_stretch(waveform, rate, window_size=2048, hop_size=None,
+                 window='hann', workers=None):
+    """Change the speed of a waveform without changing its pitch.
+
+    A rate of 2 plays twice as fast (half the length) and a rate of 0.5
+    plays at half speed (twice the length).
+
+    Returns a Waveform.
+    """
+    wavedata, framerate = _mono_wavedata(waveform)
+    if not hop_size:
+        hop_size = window_size // 4
+    _, _, spectrum = stft(wavedata, window_size, hop_size, window, workers)
+    if len(spectrum) < 2:
+        raise ValueError('The waveform is too short to stretch.')
+
+    steps = numpy.arange(0, len(spectrum) - 1, rate)
+    previous = steps.astype(int)
+    fraction = (steps - previous)[:, numpy.newaxis]
+    magnitudes = numpy.abs(spectrum)
+    magnitude = ((1 - fraction) * magnitudes[previous] +
+                 fraction * magnitudes[previous + 1])
+
+    # the phase each bin would advance by over one hop at its own frequency
+    expected = (2 * numpy.pi * hop_size *
+                numpy.arange(spectrum.shape[1]) / window_size)
+    phases = numpy.angle(spectrum)
+    advance = expected + _wrap(
+        phases[previous + 1] - phases[previous] - expected)
+    phase = numpy.empty(magnitude.shape)
+    phase[0] = phases[0]
+    numpy.cumsum(advance[:-1], axis=0, out=phase[1:])
+    phase[1:] += phases[0]
+
+    return istft(magnitude * numpy.exp(1j * phase), window_size, hop_size,
+                 window, framerate, int(round(len(wavedata) / rate)),
+                 workers)
+
+
+def pitch_shift(waveform, semitones, window_size=2048, hop_size=None,
+                window='hann', workers=None):
+    """Transpose a waveform by a number of semitones without changing speed.
+
+    The waveform is stretched by the pitch ratio with the phase vocoder and
+    then resampled back to its original length. Fractional and negative
+    semitones are allowed.
+
+    Returns a Waveform.
+    """
+    wavedata, framerate = _mono_wavedata(waveform)
+    ratio = pow(2, semitones / 12.0)
+    stretched = time_stretch(wavedata, 1.0 / ratio, window_size, hop_size,
+                             window, workers)
+    return Waveform(resample(stretched.frames, len(wavedata)), framerate)
@@ -14,35 +14,526 @@
 
 """wav.py : library for handling wav format sound files."""
 
+import io
+import sys
+import struct
+import threading
 from contextlib import contextmanager
-from pysndfile import construct_format, PySndfile
 
-from .common import defaults
+try:
+    import queue
+except ImportError:  # python 2...  bleh!
+    import Queue as queue
 
+import numpy
+from pysndfile import construct_format, encoding_id_to_name, PySndfile
 
-def wav_format_code(encoding=None):
-    """Calculate the format code for 'pcm16' encoded 'wav' files."""
+from .common import defaults, dprint
+from .waveform import Waveform
+
+
+ENCODINGS = ('pcm16', 'pcm24', 'float32')
+
+# The encodings supported in each container, the first is the default.
+CONTAINERS = {
+    'wav': ENCODINGS,
+    'flac': ('pcm16', 'pcm24'),
+    'ogg': ('vorbis',),
+}
+
+
+def container_for(filename):
+    """The container named by a filename's extension, 'wav' if unknown."""
+    extension = str(filename).rsplit('.', 1)[-1].lower()
+    return extension if extension in CONTAINERS else 'wav'
+
+
+def format_code(container=None, encoding=None):
+    """Calculate the format code for a container and encoding.
+
+    The container defaults to 'wav' and the encoding to the container's
+    default encoding.
+    """
+    if not container:
+        container = 'wav'
+    if container not in CONTAINERS:
+        raise ValueError('Unsupported container %s, use one of: %s' %
+                         (container, ', '.join(sorted(CONTAINERS))))
     if not encoding:
-        encoding = 'pcm16'
-    return construct_format('wav', encoding)
+        encoding = CONTAINERS[container][0]
+    if encoding not in CONTAINERS[container]:
+        raise ValueError('Unsupported %s encoding %s, use one of: %s' %
+                         (container, encoding,
+                          ', '.join(CONTAINERS[container])))
+    return construct_format(container, encoding)
+
+
+def format_encoding(format):
+    """The name of the encoding (e.g. 'pcm16') of a format code."""
+    return encoding_id_to_name[format & 0xFFFF]  # SF_FORMAT_SUBMASK
+
+
+def wav_format_code(encoding=None):
+    """Calculate the format code for 'wav' files, 'pcm16' by default."""
+    return format_code('wav', encoding)
+
+
+def set_compression_level(sndfile, level):
+    """Trade encoding speed for file size on a compressed format.
+
+    The level ranges from 0.0 (fastest) to 1.0 (smallest) and must be set
+    before any frames are written. Returns whether libsndfile accepted it,
+    older versions of libsndfile and pysndfile don't support the command.
+    """
+    try:
+        return bool(sndfile.command('SFC_SET_COMPRESSION_LEVEL',
+                                    float(level)))
+    except (AttributeError, KeyError, ValueError, RuntimeError):
+        return False
 
 
 def open(filename, mode=None, format=None, channels=None,
-         framerate=None):
-    """Factory method to generate PySndfile objects with wav file defaults."""
+         framerate=None, encoding=None, container=None,
+         compression_level=None):
+    """Factory method to generate PySndfile objects with wav file defaults.
+
+    The container and encoding are only used when a format code isn't
+    given. The container defaults to the one named by the filename's
+    extension (flac or ogg) or wav. See set_compression_level for the
+    compression_level of flac and ogg files.
+    """
     if not mode:
         mode = 'w'
     if not format:
-        fmt = wav_format_code()
+        if not container:
+            container = container_for(filename)
+        format = format_code(container, encoding)
     if not channels:
         channels = defaults.channels
     if not framerate:
         framerate = defaults.framerate
-    return PySndfile(filename, mode, fmt, channels, framerate)
+    sndfile = PySndfile(filename, mode, format, channels, framerate)
+    if compression_level is not None and mode != 'r':
+        if not set_compression_level(sndfile, compression_level):
+            dprint('compression level not supported for %s' % filename)
+    return sndfile
+
+
+class PCMConverter(object):
+    """Convert float frames in the range -1 to 1 to integer PCM samples.
+
+    Conversion is vectorized over whole blocks. Optional TPDF (triangular)
+    dither of +-1 LSB decorrelates the quantization error from the signal.
+    Samples beyond full scale (-1 to 1) are clipped and counted, a full
+    scale 1.0 is quietly limited to the largest positive sample. Converting
+    to float32 (or vorbis, which libsndfile encodes from floats) doesn't
+    quantize, and float32 input (see input_dtype) is passed through without
+    a copy.
+
+    24 bit samples are returned left aligned in 32 bit integers which is
+    what libsndfile expects for integer data.
+    """
+    _bits = {'pcm16': 16, 'pcm24': 24}
+    _dtypes = {'pcm16': numpy.int16, 'pcm24': numpy.int32,
+               'float32': numpy.float32, 'vorbis': numpy.float32}
+
+    def __init__(self, encoding=None, dither=False, seed=None):
+        if not encoding:
+            encoding = 'pcm16'
+        if encoding not in self._dtypes:
+            raise ValueError('Unsupported encoding %s, use one of: %s' %
+                             (encoding, ', '.join(sorted(self._dtypes))))
+        self.encoding = encoding
+        self.dither = dither
+        self.clipped = 0
+        self._random = numpy.random.RandomState(seed)
+
+    @property
+    def input_dtype(self):
+        """The float type to buffer frames in for the cheapest conversion."""
+        if self.encoding in self._bits:
+            return numpy.float64
+        return numpy.float32
+
+    def convert(self, frames):
+        """Convert a block of float frames to the target encoding."""
+        frames = numpy.asarray(frames)
+        self.clipped += int(numpy.count_nonzero(numpy.abs(frames) > 1.0))
+        if self.encoding not in self._bits:
+            return frames.astype(numpy.float32, copy=False)
+        full_scale = pow(2, self._bits[self.encoding] - 1)
+        scaled = frames * float(full_scale)
+        if self.dither:
+            scaled += self._random.triangular(-1.0, 0.0, 1.0, scaled.shape)
+        numpy.rint(scaled, out=scaled)
+        numpy.clip(scaled, -full_scale, full_scale - 1, out=scaled)
+        if self.encoding == 'pcm24':
+            scaled *= 256
+        return scaled.astype(self._dtypes[self.encoding])
+
+
+def close(sndfile):
+    """Flush and close a PySndfile object.
+
+    Older versions of pysndfile only close the file when the object is
+    deallocated.
+    """
+    if hasattr(sndfile, 'close'):
+        sndfile.close()
 
 
 @contextmanager
 def wav_file_context(*args, **kwargs):
     """Context manager for cleaning up wav file resources."""
     sndfile = open(*args, **kwargs)
-    yield sndfile
+    try:
+        yield sndfile
+    finally:
+        close(sndfile)
+
+
+class ThreadedWriter(object):
+    """Write frames to a sound file on a background thread.
+
+    Frames passed to write_frames are copied into fixed size buffers which
+    are handed to a writer thread through a bounded queue, so rendering can
+    continue while the previous buffer is written to disk. The buffers are
+    recycled rather than reallocated. When the queue is full write_frames
+    blocks until the writer thread catches up.
+
+    Use the writer as a context manager (or call close) to make sure the
+    remaining frames are written and the file is closed, even when the
+    render is interrupted. Errors raised by the writer thread are raised
+    again by the next call to write_frames or close.
+
+    Frames are converted to the encoding (see PCMConverter) on the writer
+    thread, with optional dither. The number of clipped samples is available
+    from the clipped attribute. Other keyword arguments are passed to open,
+    so the same writer streams flac or ogg files given a container (or a
+    filename with that extension) and optionally a compression_level.
+    """
+    def __init__(self, filename, block_size=None, buffers=2, encoding=None,
+                 dither=False, **kwargs):
+        if kwargs.get('format'):
+            format_name = format_encoding(kwargs['format'])
+            if encoding and encoding != format_name:
+                raise ValueError('The %s encoding does not match the %s '
+                                 'encoding of the format.' %
+                                 (encoding, format_name))
+            encoding = format_name
+        else:
+            if not kwargs.get('container'):
+                kwargs['container'] = container_for(filename)
+            if not encoding:
+                encoding = CONTAINERS[kwargs['container']][0]
+            kwargs['encoding'] = encoding
+        self.converter = PCMConverter(encoding, dither)
+        self.block_size = block_size
+        if not block_size:
+            self.block_size = defaults.block_size
+        channels = kwargs.get('channels') or defaults.channels
+        shape = ((self.block_size,) if channels == 1 else
+                 (self.block_size, channels))
+        self.sndfile = open(filename, 'w', **kwargs)
+        self.frames_written = 0
+        self._error = None
+        self._closed = False
+        self._free = queue.Queue()
+        for _ in range(buffers + 1):
+            self._free.put(numpy.empty(shape, self.converter.input_dtype))
+        self._full = queue.Queue(maxsize=buffers)
+        self._buffer = self._free.get()
+        self._fill = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """Write queued buffers until told to stop by a None."""
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            buffer, count = item
+            try:
+                if self._error is None:
+                    self.sndfile.write_frames(
+                        self.converter.convert(buffer[:count]))
+            except Exception as exc:
+                self._error = exc
+            self._free.put(buffer)
+
+    @property
+    def clipped(self):
+        """The number of samples clipped while converting so far."""
+        return self.converter.clipped
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _send(self):
+        """Queue the current buffer for writing and get an empty one."""
+        if self._fill:
+            self._full.put((self._buffer, self._fill))
+            self._buffer = self._free.get()
+            self._fill = 0
+
+    def write_frames(self, frames):
+        """Queue frames to be written, returning the number of frames."""
+        self._check()
+        if self._closed:
+            raise ValueError('Cannot write to a closed ThreadedWriter.')
+        frames = numpy.asarray(frames)
+        start = 0
+        while start < len(frames):
+            count = min(len(frames) - start, self.block_size - self._fill)
+            self._buffer[self._fill:self._fill + count] = (
+                frames[start:start + count])
+            self._fill += count
+            start += count
+            if self._fill == self.block_size:
+                self._send()
+        self.frames_written += len(frames)
+        return len(frames)
+
+    def close(self):
+        """Write any remaining frames, stop the thread and close the file."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._send()
+        finally:
+            self._full.put(None)
+            self._thread.join()
+            close(self.sndfile)
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PipeWriter(object):
+    """Stream frames to stdout or any file descriptor block by block.
+
+    Each block passed to write_frames is converted (see PCMConverter) and
+    written straight away, so audio can be piped into an encoder or player
+    without touching the disk and the first block arrives with minimal
+    latency. A WAV header with unknown (maximum) chunk sizes is written
+    first, which most tools accept for streams, or use header=False for raw
+    interleaved little endian samples.
+    """
+    _formats = {'pcm16': (1, 16), 'pcm24': (1, 24), 'float32': (3, 32)}
+    _unknown_size = 0xFFFFFFFF
+
+    def __init__(self, fileobj=None, channels=None, framerate=None,
+                 encoding=None, dither=False, header=True):
+        if fileobj is None:
+            fileobj = getattr(sys.stdout, 'buffer', sys.stdout)
+        elif isinstance(fileobj, int):
+            fileobj = io.open(fileobj, 'wb', closefd=False)
+        self.fileobj = fileobj
+        self.channels = channels if channels else defaults.channels
+        self.framerate = framerate if framerate else defaults.framerate
+        if not encoding:
+            encoding = 'pcm16'
+        if encoding not in self._formats:
+            raise ValueError('Unsupported encoding %s, use one of: %s' %
+                             (encoding, ', '.join(ENCODINGS)))
+        self.converter = PCMConverter(encoding, dither)
+        self.frames_written = 0
+        self._closed = False
+        if header:
+            self._write(self.header())
+
+    @property
+    def clipped(self):
+        """The number of samples clipped while converting so far."""
+        return self.converter.clipped
+
+    def header(self):
+        """A WAV header for a stream of unknown length."""
+        format_tag, bits = self._formats[self.converter.encoding]
+        block_align = self.channels * bits // 8
+        return struct.pack(
+            '<4sI4s4sIHHIIHH4sI', b'RIFF', self._unknown_size, b'WAVE',
+            b'fmt ', 16, format_tag, self.channels, self.framerate,
+            self.framerate * block_align, block_align, bits,
+            b'data', self._unknown_size)
+
+    def _pack(self, samples):
+        """The little endian bytes of converted samples."""
+        if self.converter.encoding == 'pcm24':
+            # keep the top three bytes of the left aligned 32 bit samples
+            samples = samples.astype('<i4').reshape(-1).view('u1')
+            return samples.reshape(-1, 4)[:, 1:].tobytes()
+        return samples.astype(samples.dtype.newbyteorder('<')).tobytes()
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.fileobj.flush()
+
+    def write_frames(self, frames):
+        """Convert and write frames, returning the number of frames."""
+        if self._closed:
+            raise ValueError('Cannot write to a closed PipeWriter.')
+        frames = numpy.asarray(frames)
+        self._write(self._pack(self.converter.convert(frames)))
+        self.frames_written += len(frames)
+        return len(frames)
+
+    def close(self):
+        """Flush the stream, leaving the file descriptor open."""
+        if not self._closed:
+            self._closed = True
+            self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class WavReader(object):
+    """Read a RIFF/WAVE file through a memory map.
+
+    Only the header is read when the reader is created. The sample data is
+    memory mapped so Waveform views and blocks are read from disk on demand,
+    which lets large recordings be analyzed without loading them first.
+    PCM (8, 16, 24 and 32 bit) and float (32 and 64 bit) data is supported.
+    """
+    _pcm_dtypes = {8: 'u1', 16: '<i2', 32: '<i4'}
+    _float_dtypes = {32: '<f4', 64: '<f8'}
+    _pcm = 1
+    _float = 3
+    _extensible = 0xFFFE
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._read_header()
+        self._map()
+
+    def _read_header(self):
+        """Find the format and data chunks of the file."""
+        with io.open(self.filename, 'rb') as fin:
+            riff, _, wave = struct.unpack('<4sI4s', fin.read(12))
+            if riff != b'RIFF' or wave != b'WAVE':
+                raise ValueError('%s is not a RIFF/WAVE file.' %
+                                 self.filename)
+            self.format_tag = None
+            while True:
+                header = fin.read(8)
+                if len(header) < 8:
+                    raise ValueError('%s has no data chunk.' % self.filename)
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+                if chunk_id == b'fmt ':
+                    self._parse_format(fin.read(chunk_size))
+                elif chunk_id == b'data':
+                    self.data_offset = fin.tell()
+                    break
+                else:
+                    fin.seek(chunk_size, io.SEEK_CUR)
+                if chunk_size % 2:  # chunks are padded to an even size
+                    fin.seek(1, io.SEEK_CUR)
+            fin.seek(0, io.SEEK_END)
+            # streamed files may not know their size so trust the file length
+            available = fin.tell() - self.data_offset
+        if self.format_tag is None:
+            raise ValueError('%s has no format chunk.' % self.filename)
+        if chunk_size == 0 or chunk_size > available:
+            chunk_size = available
+        self.framecount = chunk_size // self.block_align
+
+    def _parse_format(self, chunk):
+        """Unpack the fields of the format chunk."""
+        (self.format_tag, self.channels, self.framerate, _, self.block_align,
+         self.bits) = struct.unpack('<HHIIHH', chunk[:16])
+        if self.format_tag == self._extensible and len(chunk) >= 26:
+            self.format_tag = struct.unpack('<H', chunk[24:26])[0]
+        if self.format_tag == self._pcm:
+            supported = set(self._pcm_dtypes) | set([24])
+        elif self.format_tag == self._float:
+            supported = set(self._float_dtypes)
+        else:
+            raise ValueError('Unsupported wav format %s in %s.' %
+                             (self.format_tag, self.filename))
+        if self.bits not in supported:
+            raise ValueError('Unsupported sample size of %s bits in %s.' %
+                             (self.bits, self.filename))
+
+    def _map(self):
+        """Memory map the sample data."""
+        if self.bits == 24:
+            dtype, shape = 'u1', (self.framecount, self.channels, 3)
+        else:
+            dtypes = (self._pcm_dtypes if self.format_tag == self._pcm else
+                      self._float_dtypes)
+            dtype, shape = dtypes[self.bits], (self.framecount,
+                                               self.channels)
+        if not self.framecount:
+            self._data = numpy.zeros(shape, dtype=dtype)
+        else:
+            self._data = numpy.memmap(self.filename, dtype=dtype, mode='r',
+                                      offset=self.data_offset, shape=shape)
+
+    def __len__(self):
+        return self.framecount
+
+    @property
+    def length(self):
+        """Length of the file in seconds."""
+        return float(self.framecount) / self.framerate
+
+    @property
+    def scale(self):
+        """Multiplier that converts raw samples to the range -1 to 1."""
+        if self.format_tag == self._float:
+            return 1.0
+        return 1.0 / pow(2, self.bits - 1)
+
+    def _raw(self, start, stop):
+        """Raw samples between two frames, 24 bit data is unpacked."""
+        data = self._data[start:stop]
+        if self.bits == 24:
+            data = (data[..., 0].astype('<i4') |
+                    data[..., 1].astype('<i4') << 8 |
+                    data[..., 2].astype('i1').astype('<i4') << 16)
+        if self.channels == 1:
+            data = data[:, 0]
+        return data
+
+    def _normalized(self, data):
+        """Convert raw samples to floats in the range -1 to 1."""
+        if self.bits == 8:
+            return (data.astype(float) - 128) * self.scale
+        return data * self.scale
+
+    def waveform(self, start=0, stop=None, normalize=False):
+        """A Waveform of the frames between start and stop.
+
+        Without normalize the Waveform is a view of the raw samples in the
+        file (except 24 bit files which must be unpacked). With normalize
+        the samples are converted to floats in the range -1 to 1.
+        """
+        data = self._raw(start, stop)
+        if normalize:
+            data = self._normalized(data)
+        return Waveform(data, self.framerate, copy=False)
+
+    def blocks(self, block_size=None, normalize=True):
+        """Iterate over the file in blocks of block_size frames."""
+        if not block_size:
+            block_size = defaults.block_size
+        for start in range(0, self.framecount, block_size):
+            data = self._raw(start, start + block_size)
+            yield self._normalized(data) if normalize else data
+
+    def close(self):
+        """Release the memory map, views already handed out stay valid."""
+        self._data = None
@@ -74,25 +74,26 @@ def mix_down(first, second):
 class Waveform(object):
     """A Container for audio waveforms and associated metadata.
 
-    Supports either Mono or Stereo audio waveforms.
+    Supports either Mono or Stereo audio waveforms. Use copy=False to wrap an
+    existing array (such as a memory mapped file) without copying it.
     """
-    def __init__(self, wavedata, framerate=None):
+    def __init__(self, wavedata, framerate=None, copy=True):
         if not framerate:
             framerate = defaults.framerate
         self.framerate = framerate
-        self._set_wavedata(wavedata)
+        self._set_wavedata(wavedata, copy)
 
     def _verify_channel_count(self, channels):
         if channels < 1 or channels > 2:
             raise ValueError('Waveform only supports 1 or 2 channel audio.')
 
-    def _set_wavedata(self, wavedata):
+    def _set_wavedata(self, wavedata, copy=True):
         """Convert the wavedata into a numpy array of a consistent shape.
 
         A single array dimension is used for mono waveforms. For stereo
         waveforms a 2D array with the dimensions (framecount, 2) is used.
         """
-        tmp = numpy.array(wavedata)
+        tmp = numpy.array(wavedata) if copy else numpy.asarray(wavedata)
         if len(tmp.shape) == 1:
             self.channels = 1
             self._wavedata = tmp